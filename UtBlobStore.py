@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import errno
+import zlib
+import hashlib
+import tempfile
+
+# Content addressed store, every distinct output is kept once, zlib
+# compressed, under <path>/<2 hex>/<rest of the sha1 hex digest>.
+# Blobs are written to a temp file and renamed in place, so sessions
+# sharing a store never see a partial blob. A blob put again is touched
+# at most every TOUCH_INTERVAL seconds, well within the gc min_age, so
+# gc may run alongside live sessions.
+class UtBlobStore(object):
+    TOUCH_INTERVAL = 300
+
+    def __init__(self, path):
+        self.path = path
+        # digest -> last time the blob was written or touched
+        self.known = {}
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        now = time.time()
+        if now - self.known.get(digest, 0) < self.TOUCH_INTERVAL:
+            return digest
+        fpath = self.blob_path(digest)
+        # a blob reused by a running session is young for gc
+        if not self.touch(fpath):
+            self.write_blob(fpath, zlib.compress(data))
+        self.known[digest] = now
+        return digest
+
+    # gc may remove the blob between exists and utime
+    def touch(self, fpath):
+        try:
+            os.utime(fpath, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def write_blob(self, fpath, data):
+        dpath = os.path.dirname(fpath)
+        if not os.path.exists(dpath):
+            try:
+                os.makedirs(dpath)
+            except OSError:
+                if not os.path.isdir(dpath):
+                    raise
+        fd, tmp_fpath = tempfile.mkstemp(dir=dpath)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_fpath, fpath)
+
+    # the bytes put, unicode was put as UTF-8
+    def get(self, digest):
+        with open(self.blob_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    # Sweep of blobs outside referenced, only those untouched for min_age
+    # seconds, so the refs of a running session not yet flushed to its
+    # log are kept. Returns the number of blobs and bytes removed.
+    def gc(self, referenced, min_age, now=None):
+        if now is None:
+            now = time.time()
+        cnt, size = 0, 0
+        for dname in os.listdir(self.path):
+            dpath = os.path.join(self.path, dname)
+            if len(dname) != 2 or not os.path.isdir(dpath):
+                continue
+            for fname in os.listdir(dpath):
+                fpath = os.path.join(dpath, fname)
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                if dname + fname in referenced or \
+                   now - st.st_mtime < min_age:
+                    continue
+                try:
+                    os.remove(fpath)
+                except OSError:
+                    continue
+                self.known.pop(dname + fname, None)
+                cnt += 1
+                size += st.st_size
+        return cnt, size
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import time
+import hashlib
+import datetime
+from UtConfig import _UT_CONFIG_
+
+def file_sha1(fpath):
+    digest = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if data == "":
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+# Progress of a session, kept in <ses_path>/checkpoint.json:
+# cmd_idx    - cmds before it are done
+# exec_round - exec rounds of cmd cmd_idx done
+# success    - UtResult success counter at that point
+# attempts   - one entry per session that ran the script, a resumed
+#              session carries over the attempts before it
+# Saved at most every checkpoint_interval seconds while running, and on
+# failure and at the end.
+class UtCheckpoint(object):
+    FNAME = "checkpoint.json"
+    SCRIPT = "script"
+    SCRIPT_SHA1 = "script_sha1"
+    CMD_IDX = "cmd_idx"
+    EXEC_ROUND = "exec_round"
+    SUCCESS = "success"
+    ATTEMPTS = "attempts"
+
+    def __init__(self, ses_id, ses_path, script_fpath):
+        self.ses_id = ses_id
+        self.fpath = os.path.join(ses_path, self.FNAME)
+        self.script_fpath = script_fpath
+        self.script_sha1 = file_sha1(script_fpath)
+        self.cmd_idx = 0
+        self.exec_round = 0
+        self.success = 0
+        self.attempts = []
+        self.last_save_ts = 0.0
+
+    def is_resumed(self):
+        return self.cmd_idx > 0 or self.exec_round > 0
+
+    def resume(self, ses_path):
+        fpath = os.path.join(ses_path, self.FNAME)
+        with open(fpath, "r") as f:
+            x = json.loads(f.read())
+        if x[self.SCRIPT_SHA1] != self.script_sha1:
+            err = "Script {0} changed since checkpoint {1}".format(\
+                  self.script_fpath, fpath)
+            raise Exception(err)
+        self.cmd_idx = x[self.CMD_IDX]
+        self.exec_round = x[self.EXEC_ROUND]
+        self.success = x[self.SUCCESS]
+        self.attempts = x[self.ATTEMPTS]
+
+    def start_attempt(self):
+        self.attempts.append({"ses_id":self.ses_id, "start_idx":self.cmd_idx,
+                              "start_round":self.exec_round,
+                              "start_ts":time.time(), "end_idx":None,
+                              "end_ts":None, "rc":None, "fail_cmd":None})
+        self.save()
+
+    def update(self, cmd_idx, exec_round, success, force=False):
+        self.cmd_idx = cmd_idx
+        self.exec_round = exec_round
+        self.success = success
+        interval = time.time() - self.last_save_ts
+        if force or interval >= _UT_CONFIG_.checkpoint_interval:
+            self.save()
+
+    def finish_attempt(self, rc, fail_cmdline=None):
+        attempt = self.attempts[-1]
+        attempt["end_idx"] = self.cmd_idx
+        attempt["end_ts"] = time.time()
+        attempt["rc"] = rc
+        attempt["fail_cmd"] = fail_cmdline
+        self.save()
+
+    def save(self):
+        x = {self.SCRIPT:self.script_fpath, self.SCRIPT_SHA1:self.script_sha1,
+             self.CMD_IDX:self.cmd_idx, self.EXEC_ROUND:self.exec_round,
+             self.SUCCESS:self.success, self.ATTEMPTS:self.attempts}
+        with open(self.fpath + ".tmp", "w") as f:
+            f.write(json.dumps(x) + "\n")
+        os.rename(self.fpath + ".tmp", self.fpath)
+        self.last_save_ts = time.time()
+
+    def format_attempts(self):
+        if len(self.attempts) < 2:
+            return ""
+        s = "Attempts:\n"
+        for i, attempt in enumerate(self.attempts):
+            start_ts = datetime.datetime.fromtimestamp(attempt["start_ts"])
+            s += "#{0} {1} started {2}, from cmd #{3}".format(i + 1,
+                 attempt["ses_id"], start_ts.strftime("%Y-%m-%d %H:%M:%S"),
+                 attempt["start_idx"] + 1)
+            if attempt["start_round"] > 0:
+                s += " round #{0}".format(attempt["start_round"] + 1)
+            if attempt["end_ts"] is None:
+                s += ", interrupted\n"
+            elif attempt["fail_cmd"] is not None:
+                s += ", failed on cmd #{0} {1}\n".format(\
+                     attempt["end_idx"] + 1, attempt["fail_cmd"])
+            else:
+                s += ", to cmd #{0}, succeeded\n".format(attempt["end_idx"])
+        return s
@@ -7,7 +7,67 @@ class UtConfig(object):
         self.session_dir = "Sessions" 
         self.ssh_config_fname = "ssh_config.json"
         self.script_fname = "script.json"
-        self.log_fname = "log.json"
+        self.log_fname = "log.jsonl"
+        self.log_flush_entries = 16
+        self.log_flush_ms = 500
+        self.log_fsync = False
+        # harness logger, records queued at most, and longest argument
+        # logged in full
+        self.log_queue_size = 10000
+        self.log_max_payload = 4096
+        self.blob_dir = "Blobs"
+        self.blob_shared = True
+        self.blob_min_size = 256
+        # blobs younger than this are never swept, see uts_blob_gc.py, keep
+        # it well above UtBlobStore.TOUCH_INTERVAL
+        self.blob_gc_min_age = 3600
+        self.index_fname = "index.sqlite"
+        # run history, a cmdline regressed once its p50 or p95 is
+        # history_regress_ratio times the one of the baseline window
+        self.history = True
+        self.history_fname = "history.sqlite"
+        self.history_baseline_days = 7
+        self.history_recent_days = 1
+        self.history_regress_ratio = 1.2
+        self.history_min_samples = 5
+        self.history_min_delta = 0.05
+        # rows older are dropped, never less than the baseline and recent
+        # windows together
+        self.history_keep_days = 30
+        # "json" and/or "prom", written per session to metrics_dir, or to
+        # the session directory when empty
+        self.metrics_export = []
+        self.metrics_dir = ""
+        # outputs of cmds with a cache_ttl, shared by all sessions
+        self.result_cache = True
+        self.result_cache_fname = "result_cache.sqlite"
+        self.result_cache_max_bytes = 64 * 1024 * 1024
+        self.script_cache = True
+        self.script_cache_dir = "ScriptCache"
+        self.script_cache_max_bytes = 256 * 1024 * 1024
+        # progress of a running script is saved to the session directory
+        # at most every checkpoint_interval seconds, and on failure
+        self.checkpoint = True
+        self.checkpoint_interval = 5.0
+        self.stream_chunk_size = 32 * 1024
+        self.stream_window_size = 64 * 1024
+        self.pipeline_max_cmds = 100
+        self.parallel_max_channels = 8
+        # outputs of a load cmd logged at most, successes and failures each
+        self.load_log_samples = 10
+        self.ssh_keepalive = 30
+        self.ssh_pool_max_per_host = 4
+        self.ssh_pool_idle_timeout = 300
+        self.fleet_max_workers = 16
+        self.worker_max_jobs = 4
+        self.worker_poll_interval = 1.0
+        # seconds a job may run before its pool process is killed, 0 for
+        # no limit
+        self.worker_job_timeout = 0
+        # mails waiting to be sent at most, and digest mail bounds
+        self.notify_queue_size = 1000
+        self.notify_digest_window = 60.0
+        self.notify_digest_max = 50
 
 _UT_CONFIG_ = UtConfig()
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import time
+import datetime
+from multiprocessing.pool import ThreadPool
+from UtSSH import UtSSH
+from UtSession import UtSession, new_backend
+from UtNotify import UtNotify
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
+
+class UtHostRun(object):
+    def __init__(self, ssh):
+        self.host = ssh.ssh_detail()
+        self.session = None
+        self.err = ""
+        self.duration = 0.0
+
+    def passed(self):
+        return self.err == "" and self.session is not None and \
+               self.session.result.result == True
+
+    def result_str(self):
+        if self.err != "":
+            return "error"
+        return self.session.result.summary()
+
+    def format_line(self):
+        if self.session is not None:
+            ses_id = self.session.ses_id
+        else:
+            ses_id = "-"
+        return "{0:<32} {1:>9.1f}s  {2:<24} {3}\n".format(\
+               self.host, self.duration, ses_id, self.result_str())
+
+    def detail(self):
+        s = "{0}:\n".format(self.host)
+        if self.err != "":
+            s += self.err + "\n"
+        else:
+            s += self.session.result.detail()
+        return s
+
+# Run one script against all hosts listed in the SSH config, each host
+# gets its own session, i.e. its own log and result.
+#
+# The SSH config is either a list of host configs, or one host config
+# with a "hosts" list; an entry of "hosts" is a host_ip or a dict that
+# overrides the shared fields, e.g.
+# {"hosts":["1.1.1.1", {"host_ip":"1.1.1.2", "host_port":2222}],
+#  "host_port":22, "username":"uname", "password":"123456"}
+class UtFleet(object):
+    HOSTS = "hosts"
+    SLOWEST_CNT = 5
+
+    def __init__(self, ssh_config_fpath, script_fpath, notify_fpath,
+                 max_workers=None, ssh_pool=None, ses_tag=None):
+        self.ses_tag = ses_tag
+        self.fleet_id = self.init_fleet_id()
+        self.host_configs = self.load_host_configs(ssh_config_fpath)
+        self.script_fpath = script_fpath
+        self.notify_fpath = notify_fpath
+        self.notify = UtNotify(notify_fpath)
+        if max_workers is None:
+            max_workers = _UT_CONFIG_.fleet_max_workers
+        self.max_workers = max_workers
+        self.ssh_pool = ssh_pool
+        self.host_runs = []
+
+    def init_fleet_id(self):
+        ts = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        fleet_id = "FLEET{0}_{1}".format(ts, os.getpid())
+        if self.ses_tag is not None:
+            fleet_id += "_{0}".format(self.ses_tag)
+        return fleet_id
+
+    def host_ses_tag(self, idx):
+        ses_tag = "H{0:04d}".format(idx)
+        if self.ses_tag is not None:
+            ses_tag = "{0}_{1}".format(self.ses_tag, ses_tag)
+        return ses_tag
+
+    def load_host_configs(self, config_fpath):
+        with open(config_fpath, "r") as f:
+            config_str = f.read().rstrip()
+        config = json.loads(config_str)
+        if isinstance(config, list):
+            host_configs = config
+        elif self.HOSTS not in config:
+            host_configs = [config]
+        else:
+            host_configs = []
+            defaults = dict(config)
+            del defaults[self.HOSTS]
+            for host in config[self.HOSTS]:
+                host_config = dict(defaults)
+                if isinstance(host, dict):
+                    host_config.update(host)
+                else:
+                    host_config[UtSSH.HOST_IP] = host
+                host_configs.append(host_config)
+
+        if len(host_configs) == 0:
+            err = "No host in SSH config:\n{0}".format(config_str)
+            raise Exception(err)
+        # fail early on a broken host entry
+        for host_config in host_configs:
+            new_backend(host_config)
+        return host_configs
+
+    def run_host(self, idx):
+        host_config = self.host_configs[idx]
+        host_run = UtHostRun(new_backend(host_config))
+        start = time.time()
+        try:
+            host_run.session = UtSession(host_config, self.script_fpath,
+                                         self.notify_fpath, self.ssh_pool,
+                                         self.host_ses_tag(idx))
+            host_run.session.prepare()
+            host_run.session.go()
+        except Exception as e:
+            logger.error("Fleet: host %s failed, %s", host_run.host, e)
+            host_run.err = str(e)
+        host_run.duration = time.time() - start
+        return host_run
+
+    def go(self):
+        self.start_ts = datetime.datetime.now()
+        workers = min(self.max_workers, len(self.host_configs))
+        logger.info("Fleet: run on %d hosts, %d workers",
+                    len(self.host_configs), workers)
+        pool = ThreadPool(workers)
+        try:
+            self.host_runs = pool.map(self.run_host, \
+                                      range(len(self.host_configs)))
+        finally:
+            pool.close()
+            pool.join()
+        self.end_ts = datetime.datetime.now()
+
+    def passed_cnt(self):
+        return len([x for x in self.host_runs if x.passed()])
+
+    def summary(self):
+        return "{0}/{1} hosts passed".format(self.passed_cnt(), \
+                                             len(self.host_runs))
+
+    def detail(self):
+        start_ts = self.start_ts.strftime("%Y-%m-%d %H:%M:%S")
+        interval = (self.end_ts - self.start_ts).total_seconds()
+        s = "Fleet UT started on {0}, lasted for {1:.1f}s, {2}.\n\n".format(\
+            start_ts, interval, self.summary())
+        s += "Slowest hosts:\n"
+        host_runs = sorted(self.host_runs, key=lambda x: x.duration, \
+                           reverse=True)
+        for host_run in host_runs[:self.SLOWEST_CNT]:
+            s += host_run.format_line()
+        s += "\nPer host result:\n"
+        for host_run in self.host_runs:
+            s += host_run.format_line()
+        for host_run in self.host_runs:
+            if not host_run.passed():
+                s += "\n" + host_run.detail()
+        return s
+
+    def notify_mail(self):
+        subject = "UTS#{0}, {1}".format(self.fleet_id, self.summary())
+        return subject, self.detail()
+
+    # queued, see UtNotifyQueue
+    def send_notify(self):
+        subject, msg_body = self.notify_mail()
+        self.notify.post(subject, msg_body,
+                         self.passed_cnt() == len(self.host_runs))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import sqlite3
+import itertools
+from UtTiming import percentile
+from UtConfig import _UT_CONFIG_
+
+# Results of all sessions, kept in <root_path>/<history_fname>. One row
+# per session and one per cmd execution, each try of a retried cmd is a
+# row of its own with its attempt number. A cmdline run more than
+# CmdStats.SAMPLE_MAX times in a session gets a uniform sample of its
+# executions. ts of a cmd is the start of its session. A session is
+# written in one transaction when it ends, rows older than
+# history_keep_days are dropped then.
+class UtHistory(object):
+    PERCENTILES = [50, 95, 99]
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS sessions (ses_id TEXT PRIMARY KEY, "
+        "host TEXT, script TEXT, start_ts REAL, duration REAL, rc INTEGER, "
+        "total INTEGER, success INTEGER)",
+        "CREATE TABLE IF NOT EXISTS cmds (ses_id TEXT, host TEXT, "
+        "cmdline TEXT, ts REAL, attempt INTEGER, rc INTEGER, "
+        "duration REAL)",
+        "CREATE INDEX IF NOT EXISTS cmds_cmdline ON cmds (cmdline, ts)",
+        "CREATE INDEX IF NOT EXISTS cmds_host ON cmds (host, ts)",
+        "CREATE INDEX IF NOT EXISTS cmds_ts ON cmds (ts)",
+        "CREATE INDEX IF NOT EXISTS sessions_ts ON sessions (start_ts)"]
+
+    def __init__(self, fpath=None):
+        if fpath is None:
+            fpath = os.path.join(_UT_CONFIG_.root_path,
+                                 _UT_CONFIG_.history_fname)
+        self.fpath = fpath
+        self.conn = None
+
+    # sessions of several worker processes write to the same file
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.fpath, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                for stmt in self.SCHEMA:
+                    self.conn.execute(stmt)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def add_session(self, session):
+        result = session.result
+        start_ts = time.mktime(result.start_ts.timetuple())
+        host = session.ssh.ssh_detail()
+        rows = ((session.ses_id, host, cmdline, start_ts, attempt, rc,
+                 duration) for cmdline, stats in result.cmd_stats.iteritems()
+                for attempt, rc, duration in stats.samples)
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?)",
+                         (session.ses_id, host, session.script.fpath,
+                          start_ts, result.duration(), result.rc,
+                          result.total, result.success))
+            conn.execute("DELETE FROM cmds WHERE ses_id = ?",
+                         (session.ses_id,))
+            conn.executemany("INSERT INTO cmds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             rows)
+            self.prune(conn, time.time())
+
+    # the windows compared by regressions are always kept
+    def prune(self, conn, now):
+        keep_days = max(_UT_CONFIG_.history_keep_days,
+                        _UT_CONFIG_.history_baseline_days + \
+                        _UT_CONFIG_.history_recent_days)
+        oldest = now - keep_days * 86400
+        conn.execute("DELETE FROM cmds WHERE ts < ?", (oldest,))
+        conn.execute("DELETE FROM sessions WHERE start_ts < ?", (oldest,))
+
+    def cmd_filter(self, cmdline=None, host=None, since=None, until=None):
+        conds, args = [], []
+        for cond, arg in [("cmdline = ?", cmdline), ("host = ?", host),
+                          ("ts >= ?", since), ("ts < ?", until)]:
+            if arg is not None:
+                conds.append(cond)
+                args.append(arg)
+        if len(conds) == 0:
+            return "", args
+        return " WHERE " + " AND ".join(conds), args
+
+    # sqlite would rather take cmds_host when a host is given too, and
+    # walk all cmds of the host
+    def cmd_table(self, cmdline=None):
+        if cmdline is None:
+            return " FROM cmds"
+        return " FROM cmds INDEXED BY cmds_cmdline"
+
+    # cmdline -> count, duration percentiles, retry rate (retries per exec
+    # round) and fail rate (failed tries per try)
+    def cmd_stats(self, cmdline=None, host=None, since=None, until=None):
+        where, args = self.cmd_filter(cmdline, host, since, until)
+        cursor = self.connect().execute(
+            "SELECT cmdline, duration, attempt, rc" + self.cmd_table(cmdline) +
+            where +
+            " ORDER BY cmdline, duration", args)
+        stats = {}
+        for cmdline, rows in itertools.groupby(cursor, lambda x: x[0]):
+            durations, rounds, retries, fails = [], 0, 0, 0
+            for x, duration, attempt, rc in rows:
+                durations.append(duration)
+                if attempt == 1:
+                    rounds += 1
+                else:
+                    retries += 1
+                if rc != 0:
+                    fails += 1
+            stats[cmdline] = summarize(durations)
+            stats[cmdline]["retry_rate"] = float(retries) / max(rounds, 1)
+            stats[cmdline]["fail_rate"] = float(fails) / len(durations)
+        return stats
+
+    # duration percentiles of a cmdline per bucket of bucket_secs
+    def cmd_trend(self, cmdline, host=None, since=None, until=None,
+                  bucket_secs=86400):
+        where, args = self.cmd_filter(cmdline, host, since, until)
+        cursor = self.connect().execute(
+            "SELECT ts, duration" + self.cmd_table(cmdline) + where +
+            " ORDER BY ts", args)
+        trend = []
+        for bucket, rows in itertools.groupby(cursor,
+                lambda x: int(x[0] // bucket_secs)):
+            x = summarize(sorted([duration for ts, duration in rows]))
+            x["ts"] = bucket * bucket_secs
+            trend.append(x)
+        return trend
+
+    # cmdlines slower over the recent window than over the baseline window
+    # before it, on a host or on all hosts
+    def regressions(self, host=None, now=None):
+        if now is None:
+            now = time.time()
+        recent_start = now - _UT_CONFIG_.history_recent_days * 86400
+        baseline_start = recent_start - \
+                         _UT_CONFIG_.history_baseline_days * 86400
+        recent = self.cmd_stats(host=host, since=recent_start, until=now)
+        baseline = self.cmd_stats(host=host, since=baseline_start,
+                                  until=recent_start)
+        return compare(recent, baseline)
+
+    # cmdlines of a session slower than over the baseline window before
+    # it. Runs at the end of every session, only the cmdlines it ran are
+    # read, one by one through the cmds_cmdline index.
+    def session_regressions(self, session):
+        start_ts = time.mktime(session.result.start_ts.timetuple())
+        since = start_ts - _UT_CONFIG_.history_baseline_days * 86400
+        host = session.ssh.ssh_detail()
+        current = session.result.cmd_summaries(UtHistory.PERCENTILES)
+        baseline = {}
+        for cmdline in current:
+            baseline.update(self.cmd_stats(cmdline, host, since, start_ts))
+        return compare(current, baseline)
+
+def summarize(sorted_durations):
+    x = {"count":len(sorted_durations)}
+    for p in UtHistory.PERCENTILES:
+        x["p{0}".format(p)] = percentile(sorted_durations, p)
+    return x
+
+# Regressions sorted by ratio, the largest of p50 and p95 against the
+# baseline. Baselines of fewer than history_min_samples executions are
+# skipped, and so are changes below history_min_delta seconds, noise of
+# the quick cmds. A current with fewer executions, e.g. a cmd run once by
+# a session, must also be slower than the baseline p95 to count.
+def compare(current, baseline):
+    min_samples = _UT_CONFIG_.history_min_samples
+    regressions = []
+    for cmdline in current:
+        x, y = current[cmdline], baseline.get(cmdline)
+        if y is None or y["count"] < min_samples:
+            continue
+        if x["count"] < min_samples and x["p50"] <= y["p95"]:
+            continue
+        ratio = max([x[p] / y[p] for p in ["p50", "p95"] if y[p] > 0 and \
+                     x[p] - y[p] >= _UT_CONFIG_.history_min_delta] or [1.0])
+        if ratio >= _UT_CONFIG_.history_regress_ratio:
+            regressions.append({"cmdline":cmdline, "ratio":ratio,
+                                "current":x, "baseline":y})
+    regressions.sort(key=lambda x: -x["ratio"])
+    return regressions
+
+def format_stats(stats):
+    s = "{0:>7} {1:>9} {2:>9} {3:>9} {4:>6} {5:>6}  {6}\n".format(\
+        "count", "p50", "p95", "p99", "retry", "fail", "cmdline")
+    for cmdline in sorted(stats, key=lambda x: -stats[x]["p95"]):
+        x = stats[cmdline]
+        s += "{0:>7} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>6.1%} {5:>6.1%}  "\
+             "{6}\n".format(x["count"], x["p50"], x["p95"], x["p99"],
+                            x["retry_rate"], x["fail_rate"], cmdline)
+    return s
+
+def format_regressions(regressions):
+    s = "{0:>6} {1:>17} {2:>17}  {3}\n".format(\
+        "ratio", "p50 now/before", "p95 now/before", "cmdline")
+    for x in regressions:
+        cur, base = x["current"], x["baseline"]
+        s += "{0:>6.2f} {1:>8.3f}/{2:<8.3f} {3:>8.3f}/{4:<8.3f}  {5}\n"\
+             .format(x["ratio"], cur["p50"], base["p50"], cur["p95"],
+                     base["p95"], x["cmdline"])
+    return s
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import mmap
+import sqlite3
+import datetime
+from UtLog import load_entry, find_blob_store, read_log_lines, \
+                  LogEntry, LogEntryAction, LogEntryResult
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
+
+# One row per command run, added when a session finishes, a query gets
+# each as a dict, e.g.
+# {"ses": "SES20260101120000_42", "host": "uname@1.1.1.1:22",
+#  "cmd": "ls -l", "rc": 0, "start": 1767268800, "end": 1767268801,
+#  "off": 1024, "len": 96}
+# off/len locate the result entry in the session log, so a query reads
+# back only the entries it matched.
+class UtIndexRecord(object):
+    SES = "ses"
+    HOST = "host"
+    CMD = "cmd"
+    RC = "rc"
+    START = "start"
+    END = "end"
+    OFF = "off"
+    LEN = "len"
+    UNKNOWN_HOST = "-"
+    FIELDS = [SES, HOST, CMD, RC, START, END, OFF, LEN]
+
+    @staticmethod
+    def format_line(x):
+        ts = datetime.datetime.fromtimestamp(x[UtIndexRecord.END])
+        return "{0} {1:<28} {2:<28} rc={3} {4}".format(\
+               ts.strftime("%Y-%m-%d %H:%M:%S"), x[UtIndexRecord.SES],
+               x[UtIndexRecord.HOST], x[UtIndexRecord.RC],
+               x[UtIndexRecord.CMD])
+
+# Kept in <root_path>/<index_fname>, ses, host, rc and end are indexed so
+# those filters and time ranges read only the rows they match. Rows are
+# returned most recently indexed first.
+class UtIndex(object):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS cmds (id INTEGER PRIMARY KEY, "
+        "ses TEXT, host TEXT, cmd TEXT, rc INTEGER, start REAL, "
+        "\"end\" REAL, off INTEGER, len INTEGER)",
+        "CREATE INDEX IF NOT EXISTS cmds_ses ON cmds (ses)",
+        "CREATE INDEX IF NOT EXISTS cmds_host ON cmds (host, \"end\")",
+        "CREATE INDEX IF NOT EXISTS cmds_rc ON cmds (rc, \"end\")",
+        "CREATE INDEX IF NOT EXISTS cmds_failed ON cmds (id) "
+        "WHERE rc <> 0",
+        "CREATE INDEX IF NOT EXISTS cmds_end ON cmds (\"end\")"]
+    COLUMNS = ", ".join('"{0}"'.format(name) for name in UtIndexRecord.FIELDS)
+
+    def __init__(self, fpath=None):
+        if fpath is None:
+            fpath = os.path.join(_UT_CONFIG_.root_path,
+                                 _UT_CONFIG_.index_fname)
+        self.fpath = fpath
+        self.conn = None
+
+    def ses_path(self, ses_id):
+        return os.path.join(os.path.dirname(self.fpath),
+                            _UT_CONFIG_.session_dir, ses_id)
+
+    # sessions finish concurrently in fleet threads and worker processes
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.fpath, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                for stmt in self.SCHEMA:
+                    self.conn.execute(stmt)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # all rows of a session in one transaction
+    def append(self, ses_id, host, records):
+        if len(records) == 0:
+            return
+        conn = self.connect()
+        with conn:
+            conn.executemany("INSERT INTO cmds ({0}) VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?, ?)".format(self.COLUMNS),
+                             ((ses_id, host) + tuple(x) for x in records))
+
+    def add_session(self, session):
+        try:
+            self.append(session.ses_id, session.ssh.ssh_detail(),
+                        session.log.index_records)
+        finally:
+            self.close()
+
+    def query_filter(self, ses_id, host, cmd, rc, failed, since, until):
+        conds, args = [], []
+        for cond, arg in [("ses = ?", ses_id), ("host = ?", host),
+                          ("instr(cmd, ?) > 0", cmd or None),
+                          ("rc = ?", rc), ('"end" >= ?', since),
+                          ('"end" <= ?', until)]:
+            if arg is not None:
+                conds.append(cond)
+                args.append(arg)
+        # as written in the partial index, so it can be used
+        if failed:
+            conds.append("rc <> 0")
+        if len(conds) == 0:
+            return "", args
+        return " WHERE " + " AND ".join(conds), args
+
+    def query(self, ses_id=None, host=None, cmd=None, rc=None, failed=False,
+              since=None, until=None, limit=None):
+        where, args = self.query_filter(ses_id, host, cmd, rc, failed,
+                                        since, until)
+        sql = "SELECT {0} FROM cmds{1} ORDER BY id DESC".format(self.COLUMNS,
+                                                               where)
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        if not os.path.exists(self.fpath):
+            return
+        for row in self.connect().execute(sql, args):
+            yield dict(zip(UtIndexRecord.FIELDS, row))
+
+    # the result entry of a matched record, read through a mapping of the
+    # session log without parsing the rest of it
+    def read_result(self, x):
+        ses_path = self.ses_path(x[UtIndexRecord.SES])
+        fpath = os.path.join(ses_path, _UT_CONFIG_.log_fname)
+        with open(fpath, "r") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                off = x[UtIndexRecord.OFF]
+                entry_str = mm[off:off + x[UtIndexRecord.LEN]]
+            finally:
+                mm.close()
+        return load_entry(entry_str, find_blob_store(ses_path))
+
+    def indexed_sessions(self):
+        rows = self.connect().execute("SELECT DISTINCT ses FROM cmds")
+        return set(row[0] for row in rows)
+
+    # records of the JSON lines index of former versions, hosts included
+    def import_jsonl(self, fpath, indexed):
+        sessions, keys = {}, []
+        for line in read_log_lines(fpath):
+            x = json.loads(line)
+            ses_id = x[UtIndexRecord.SES]
+            if ses_id in indexed:
+                continue
+            record = tuple(x[name] for name in UtIndexRecord.FIELDS[2:])
+            key = (ses_id, x[UtIndexRecord.HOST])
+            if key not in sessions:
+                sessions[key] = []
+                keys.append(key)
+            sessions[key].append(record)
+        for ses_id, host in keys:
+            self.append(ses_id, host, sessions[(ses_id, host)])
+            indexed.add(ses_id)
+        return len(sessions)
+
+    # Sessions which never reached the index, e.g. run before it existed
+    # or killed before they finished. Their host is not in the log, but
+    # is kept by the JSON lines index of former versions when found.
+    def reindex(self):
+        indexed = self.indexed_sessions()
+        cnt = 0
+        jsonl_fpath = os.path.splitext(self.fpath)[0] + ".jsonl"
+        if jsonl_fpath != self.fpath and os.path.isfile(jsonl_fpath):
+            cnt += self.import_jsonl(jsonl_fpath, indexed)
+        sessions_path = os.path.dirname(self.ses_path("x"))
+        if not os.path.isdir(sessions_path):
+            return cnt
+        for ses_id in sorted(os.listdir(sessions_path)):
+            fpath = os.path.join(sessions_path, ses_id, _UT_CONFIG_.log_fname)
+            if ses_id in indexed or not os.path.isfile(fpath):
+                continue
+            records = read_index_records(fpath)
+            self.append(ses_id, UtIndexRecord.UNKNOWN_HOST, records)
+            logger.info("Index: %s, %d commands", ses_id, len(records))
+            cnt += 1
+        return cnt
+
+# (cmd, rc, start, end, off, len) of every command in a session log
+def read_index_records(fpath):
+    records = []
+    off, action = 0, None
+    for line in read_log_lines(fpath):
+        x = json.loads(line)
+        if x[LogEntry.TYPE] == LogEntryAction.TYPE_ACTION:
+            action = x
+        elif action is not None:
+            records.append((action[LogEntryAction.DESC],
+                            x[LogEntryResult.RC], action[LogEntry.TS],
+                            x[LogEntry.TS], off, len(line)))
+            action = None
+        off += len(line) + 1
+    return records
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import errno
+import select
+import signal
+import socket
+import threading
+import subprocess
+from UtLogger import logger
+from UtUtil import OutputWindow, CmdTimeout, EXEC_TIMEOUT
+from UtTiming import CmdTiming, monotonic
+from UtConfig import _UT_CONFIG_
+
+# Runs the cmds of a session on this host instead of over SSH, with the
+# same rc, out and err as UtSSH, e.g. smoke scripts on a build agent.
+# Selected by "backend": "local" in the SSH config, which may also set
+# cwd, cmd_timeout and session_timeout, e.g.
+# {"backend":"local", "cwd":"/tmp", "cmd_timeout":60}
+# Every cmd runs in a shell of its own process group, the group is killed
+# on timeout, or once a stream cmd is stopped early.
+class UtLocal(object):
+    BACKEND = "backend"
+    BACKEND_LOCAL = "local"
+    CWD = "cwd"
+    CMD_TIMEOUT = "cmd_timeout"
+    SESSION_TIMEOUT = "session_timeout"
+    KILL_GRACE = 5
+
+    def __init__(self, config):
+        self.validate_input_config(config)
+        self.cwd = config.get(self.CWD, None)
+        # seconds, 0 is no limit
+        self.cmd_timeout = config.get(self.CMD_TIMEOUT, 0)
+        self.session_timeout = config.get(self.SESSION_TIMEOUT, 0)
+        # cmds are not batched, there is no remote call to save
+        self.pipeline = False
+        self.deadline = None
+
+    def validate_input_config(self, config):
+        if config.get(self.BACKEND) != self.BACKEND_LOCAL:
+            err = "Not a local backend config:\n{0}".format(config)
+            raise Exception(err)
+
+        cwd = config.get(self.CWD, None)
+        if cwd is not None and not os.path.isdir(cwd):
+            err = "Local cwd {0} is not a directory".format(cwd)
+            raise Exception(err)
+
+        for name in [self.CMD_TIMEOUT, self.SESSION_TIMEOUT]:
+            timeout = config.get(name, 0)
+            if isinstance(timeout, bool) or \
+               not isinstance(timeout, (int, float)) or timeout < 0:
+                err = "Local {0} should be a number of seconds".format(name)
+                raise Exception(err)
+
+    def ssh_detail(self):
+        return "local@{0}".format(socket.gethostname())
+
+    def connect(self):
+        if self.session_timeout > 0:
+            self.deadline = monotonic() + self.session_timeout
+
+    def close(self):
+        pass
+
+    # every cmd is a process of its own, there is no transport to add
+    def open_transport(self):
+        return self
+
+    # same as UtSSH.cmd_deadline
+    def cmd_deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.cmd_timeout
+        deadline = self.deadline
+        if timeout > 0:
+            deadline = min(deadline or float("inf"), monotonic() + timeout)
+        return deadline
+
+    def format_timeout(self, cmdline, err=""):
+        if err != "" and not err.endswith("\n"):
+            err += "\n"
+        return err + "Timeout running cmd {0}, {1}".format(\
+               cmdline, self.ssh_detail())
+
+    # SIGKILL follows if SIGTERM is not enough, without waiting for it
+    def kill(self, p):
+        logger.info("LOCAL: kill process group %d", p.pid)
+        self.signal_group(p, signal.SIGTERM)
+        t = threading.Timer(self.KILL_GRACE, self.force_kill, args=(p,))
+        t.daemon = True
+        t.start()
+
+    def force_kill(self, p):
+        if p.poll() is None:
+            self.signal_group(p, signal.SIGKILL)
+            p.wait()
+
+    def signal_group(self, p, sig):
+        try:
+            os.killpg(p.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    # Appends the chunks of stdout and stderr to out and err as they
+    # arrive, select wakes up on either pipe. on_chunk(chunk) is called for
+    # every stdout chunk, returning True stops the cmd. Raises CmdTimeout
+    # once the deadline is passed.
+    def run(self, cmdline, out, err, timing, deadline, on_chunk=None):
+        if deadline is not None and deadline <= monotonic():
+            raise CmdTimeout(cmdline)
+        with timing.phase(CmdTiming.OPEN):
+            with open(os.devnull, "r") as devnull:
+                p = subprocess.Popen(cmdline, shell=True, cwd=self.cwd,
+                                     stdin=devnull, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, close_fds=True,
+                                     preexec_fn=os.setsid)
+        out_fd = p.stdout.fileno()
+        streams = {out_fd:out, p.stderr.fileno():err}
+        chunk_size = _UT_CONFIG_.stream_chunk_size
+        start = monotonic()
+        first_ts = None
+        stopped = False
+        try:
+            while len(streams) > 0:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - monotonic()
+                    if wait <= 0:
+                        self.kill(p)
+                        timing.add_exec_read(start, first_ts)
+                        raise CmdTimeout(cmdline)
+                try:
+                    ready, _, _ = select.select(streams.keys(), [], [], wait)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd in ready:
+                    chunk = os.read(fd, chunk_size)
+                    if chunk == "":
+                        del streams[fd]
+                        continue
+                    if first_ts is None:
+                        first_ts = monotonic()
+                    streams[fd].append(chunk)
+                    if fd == out_fd and on_chunk is not None and \
+                       on_chunk(chunk):
+                        logger.info("LOCAL: verdict settled, stop cmd")
+                        self.kill(p)
+                        stopped = True
+                        streams = {}
+                        break
+        finally:
+            p.stdout.close()
+            p.stderr.close()
+        # a killed cmd is reaped by force_kill
+        if not stopped:
+            p.wait()
+        timing.add_exec_read(start, first_ts)
+
+    def exec_cmd(self, cmdline, timing=None, timeout=None):
+        logger.info("LOCAL: Run cmd '%s'", cmdline)
+        if timing is None:
+            timing = CmdTiming(cmdline)
+        rc = True
+        out, err = [], []
+        try:
+            self.run(cmdline, out, err, timing, self.cmd_deadline(timeout))
+            out, err = "".join(out), "".join(err)
+        except CmdTimeout:
+            rc = EXEC_TIMEOUT
+            out = "".join(out)
+            err = self.format_timeout(cmdline, "".join(err))
+        except Exception as e:
+            rc = False
+            err = "Fail to exec cmd {0}, {1}, {2}".format(\
+                  cmdline, str(e), self.ssh_detail())
+            out = err
+        logger.debug("LOCAL: exec_cmd rc %s", rc)
+        logger.debug("LOCAL: exec_cmd out:\n%s", out)
+        logger.debug("LOCAL: exec_cmd err:\n%s", err)
+        return rc, out, err
+
+    # only a head/tail window of the output is kept, as UtSSH does
+    def exec_cmd_stream(self, cmdline, on_chunk, timing=None, timeout=None):
+        logger.info("LOCAL: Stream cmd '%s'", cmdline)
+        if timing is None:
+            timing = CmdTiming(cmdline)
+        rc = True
+        out = OutputWindow(_UT_CONFIG_.stream_window_size)
+        err = OutputWindow(_UT_CONFIG_.stream_window_size)
+        try:
+            self.run(cmdline, out, err, timing, self.cmd_deadline(timeout),
+                     on_chunk)
+            out, err = out.text(), err.text()
+        except CmdTimeout:
+            rc = EXEC_TIMEOUT
+            out, err = out.text(), self.format_timeout(cmdline, err.text())
+        except Exception as e:
+            rc = False
+            err = "Fail to exec cmd {0}, {1}, {2}".format(\
+                  cmdline, str(e), self.ssh_detail())
+            out = err
+        logger.debug("LOCAL: exec_cmd_stream rc %s, out %d bytes, "\
+                     "err %d bytes", rc, len(out), len(err))
+        return rc, out, err
+
+def is_local(config):
+    return isinstance(config, dict) and \
+           config.get(UtLocal.BACKEND) == UtLocal.BACKEND_LOCAL
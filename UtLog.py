@@ -1,23 +1,35 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
 import json
 import time
 import datetime
+import threading
+from UtBlobStore import UtBlobStore
 from UtConfig import UtConfig, _UT_CONFIG_
 
+# Outputs read back from the blob store are the bytes of the cmd, not
+# always UTF-8, decoded for display only
+def output_text(data):
+    if isinstance(data, str):
+        return data.decode("utf-8", "replace")
+    return data
+
 class LogEntry(object):
+    __slots__ = ("ts",)
     TYPE = "type"
     TS = "ts"
 
+    # millisecond resolution
     def get_ts_now(self):
-        return int(time.time())
+        return round(time.time(), 3)
 
-    def to_json(self):
+    def to_json(self, blob_store=None):
         return ""
 
-    def from_json(self):
-        pass
+    def from_json(self, x, blob_store=None):
+        self.ts = x[self.TS]
 
     def to_plain_text(self):
         return ""
@@ -26,6 +38,7 @@ class LogEntry(object):
         return datetime.datetime.fromtimestamp(self.ts).strftime("%H:%M")
 
 class LogEntryAction(LogEntry):
+    __slots__ = ("desc",)
     TYPE_ACTION = "action"
     DESC = "desc"
 
@@ -33,7 +46,7 @@ class LogEntryAction(LogEntry):
         self.ts = self.get_ts_now()
         self.desc = desc
 
-    def to_json(self):
+    def to_json(self, blob_store=None):
         x = {}
         x[self.TYPE] = self.TYPE_ACTION
         x[self.TS] = self.ts
@@ -41,80 +54,280 @@ class LogEntryAction(LogEntry):
         s = json.dumps(x)
         return s
 
+    def from_json(self, x, blob_store=None):
+        LogEntry.from_json(self, x)
+        self.desc = x[self.DESC]
+
     def to_plain_text(self):
         ts = self.get_plain_text_time()
-        s = "[{0}] ${1}\n".format(ts, self.desc)
+        s = u"[{0}] ${1}\n".format(ts, self.desc)
         return s
 
+# With a blob store, out/err of at least blob_min_size bytes are stored
+# as blobs and referenced by digest in out_ref/err_ref. cached is the age
+# in seconds of an output served by the result cache, None when the cmd
+# was executed.
 class LogEntryResult(LogEntry):
+    __slots__ = ("rc", "out", "err", "cached")
     TYPE_RESULT = "result"
     RC = "rc"
     OUT = "out"
     ERR = "err"
+    CACHED = "cached"
+    REF_SUFFIX = "_ref"
 
-    def __init__(self, rc=True, out="", err=""):
+    def __init__(self, rc=True, out="", err="", cached=None):
         self.ts = self.get_ts_now()
         self.rc = rc
         self.out = out.strip()
         self.err = err.strip()
+        self.cached = cached
 
-    def to_json(self):
+    def to_json(self, blob_store=None):
         x = {}
         x[self.TYPE] = self.TYPE_RESULT
         x[self.TS] = self.ts
         x[self.RC] = self.rc
-        x[self.OUT] = self.out
-        x[self.ERR] = self.err
+        self.put_output(x, self.OUT, self.out, blob_store)
+        self.put_output(x, self.ERR, self.err, blob_store)
+        if self.cached is not None:
+            x[self.CACHED] = round(self.cached, 3)
         s = json.dumps(x)
         return s
 
+    def put_output(self, x, name, data, blob_store):
+        if blob_store is None or len(data) < _UT_CONFIG_.blob_min_size:
+            x[name] = data
+        else:
+            x[name + self.REF_SUFFIX] = blob_store.put(data)
+
+    def from_json(self, x, blob_store=None):
+        LogEntry.from_json(self, x)
+        self.rc = x[self.RC]
+        self.out = self.get_output(x, self.OUT, blob_store)
+        self.err = self.get_output(x, self.ERR, blob_store)
+        self.cached = x.get(self.CACHED, None)
+
+    def get_output(self, x, name, blob_store):
+        if name in x:
+            return x[name]
+        return blob_store.get(x[name + self.REF_SUFFIX])
+
     def to_plain_text(self):
         ts = self.get_plain_text_time()
-        if self.out == "" and self.err == "":
+        self_out, self_err = output_text(self.out), output_text(self.err)
+        if self_out == "" and self_err == "":
             out = ""
-        elif self.out == "":
-            out = self.err
-        elif self.err == "":
-            out = self.out
+        elif self_out == "":
+            out = self_err
+        elif self_err == "":
+            out = self_out
         else:
-            out = self.out + "\n" + self.err
-        s = "[{0}] $".format(ts)
+            out = self_out + u"\n" + self_err
+        s = u"[{0}] $".format(ts)
+        if self.cached is not None:
+            s += u" (cached {0:.0f}s ago)".format(self.cached)
         if out != "":
-            s += "\n{0}".format(out)
+            s += u"\n{0}".format(out)
         s += "\n"
         return s
 
+def load_entry(entry_str, blob_store=None):
+    x = json.loads(entry_str)
+    if x[LogEntry.TYPE] == LogEntryAction.TYPE_ACTION:
+        entry = LogEntryAction("")
+    else:
+        entry = LogEntryResult()
+    entry.from_json(x, blob_store)
+    return entry
+
+# shared by all sessions, or one per session
+def get_blob_store(ses_path):
+    if _UT_CONFIG_.blob_shared:
+        path = os.path.join(_UT_CONFIG_.root_path, _UT_CONFIG_.blob_dir)
+    else:
+        path = os.path.join(ses_path, _UT_CONFIG_.blob_dir)
+    return UtBlobStore(path)
+
+# blob store of an existing session, either its own or the shared one
+# next to the Sessions directory
+def find_blob_store(ses_path):
+    root_path = os.path.dirname(os.path.dirname(os.path.abspath(ses_path)))
+    for path in [os.path.join(ses_path, _UT_CONFIG_.blob_dir),
+                 os.path.join(root_path, _UT_CONFIG_.blob_dir)]:
+        if os.path.isdir(path):
+            return UtBlobStore(path)
+    return None
+
+# digests referenced by the result entries of a log
+def read_blob_refs(fpath):
+    names = [LogEntryResult.OUT + LogEntryResult.REF_SUFFIX,
+             LogEntryResult.ERR + LogEntryResult.REF_SUFFIX]
+    for line in read_log_lines(fpath):
+        if LogEntryResult.REF_SUFFIX not in line:
+            continue
+        x = json.loads(line)
+        for name in names:
+            if name in x:
+                yield x[name]
+
+# Garbage collection of the shared blob store, the blobs referenced by the
+# logs of the remaining sessions are marked, the others swept. A session
+# store goes away with its session directory.
+def gc_shared_blobs(root_path=None, min_age=None):
+    if root_path is None:
+        root_path = _UT_CONFIG_.root_path
+    if min_age is None:
+        min_age = _UT_CONFIG_.blob_gc_min_age
+    path = os.path.join(root_path, _UT_CONFIG_.blob_dir)
+    if not os.path.isdir(path):
+        return 0, 0
+    referenced = set()
+    ses_root = os.path.join(root_path, _UT_CONFIG_.session_dir)
+    if os.path.isdir(ses_root):
+        for ses_id in os.listdir(ses_root):
+            fpath = os.path.join(ses_root, ses_id, _UT_CONFIG_.log_fname)
+            if os.path.isfile(fpath):
+                referenced.update(read_blob_refs(fpath))
+    return UtBlobStore(path).gc(referenced, min_age)
+
+# Entries are not kept in memory, only an index record per command with
+# the file offset and length of its result, the entries are read back
+# from the log file when needed.
 class UtLog(object):
-    def __init__(self, ssh):
-        self.fname = _UT_CONFIG_.log_fname
-        self.entry_list = []
-        self.ssh = ssh
+    def __init__(self, session):
+        self.fname = os.path.join(session.ses_path, _UT_CONFIG_.log_fname)
+        self.size = 0
+        self.session = session
+        self.blob_store = get_blob_store(session.ses_path)
+        self.f = None
+        self.pending = []
+        self.last_flush_ts = time.time()
+        # the flusher thread writes out the entries of a cmd still running
+        self.lock = threading.Lock()
+        self.stop_flusher = threading.Event()
+        self.flusher = None
+        # (cmd, rc, start, end, off, len) of each command, see UtIndex
+        self.index_records = []
+        self.last_action = None
 
+    # JSON Lines, one entry per line, only ever appended
     def init_log_file(self):
-        with open(self.fname, "w") as f:
-            f.write("[\n\n]\n")
+        self.f = open(self.fname, "w")
+        self.start_flusher()
+
+    # entries are otherwise only flushed by the next one, the action entry
+    # of a hung cmd would wait for it
+    def start_flusher(self):
+        interval = _UT_CONFIG_.log_flush_ms / 1000.0
+        if interval <= 0:
+            return
+        def flush_pending():
+            while not self.stop_flusher.wait(interval):
+                with self.lock:
+                    if time.time() - self.last_flush_ts >= interval:
+                        self.flush_entries()
+        self.flusher = threading.Thread(target=flush_pending,
+                                        name="UtLogFlusher")
+        self.flusher.daemon = True
+        self.flusher.start()
 
     def add_action_entry(self, desc):
-        entry = LogEntryAction(desc)
-        self.entry_list.append(entry)
-        self.flush_entry(entry.to_json())
-
-    def add_result_entry(self, rc, out, err):
-        entry = LogEntryResult(rc, out, err)
-        self.entry_list.append(entry)
-        self.flush_entry(entry.to_json())
-
-    def flush_entry(self, entry_str):
-        with open(self.fname, "a") as f:
-            f.truncate(f.tell()-3) #remove the ending \n]\n
-            f.seek(f.tell()-3)
-            if f.tell() > 3: # 2 = len("\n[\n")
-                f.write(",\n")
-            f.write(entry_str+"\n]\n")
+        self.add_entry(LogEntryAction(desc))
+
+    def add_result_entry(self, rc, out, err, cached=None):
+        self.add_entry(LogEntryResult(rc, out, err, cached))
+
+    def add_entry(self, entry):
+        entry_str = entry.to_json(self.blob_store)
+        self.add_index_record(entry, self.size, len(entry_str))
+        self.size += len(entry_str) + 1
+        with self.lock:
+            self.pending.append(entry_str)
+            interval = (time.time() - self.last_flush_ts) * 1000
+            if len(self.pending) >= _UT_CONFIG_.log_flush_entries or \
+               interval >= _UT_CONFIG_.log_flush_ms:
+                self.flush_entries()
+
+    def add_index_record(self, entry, off, length):
+        if isinstance(entry, LogEntryAction):
+            self.last_action = entry
+        elif self.last_action is not None:
+            action = self.last_action
+            self.index_records.append((action.desc, entry.rc, action.ts,
+                                       entry.ts, off, length))
+            self.last_action = None
+
+    # entries are written as whole lines, a crash leaves at most one
+    # partial line at the end, which the reader skips
+    def flush(self):
+        with self.lock:
+            self.flush_entries()
+
+    def flush_entries(self):
+        if len(self.pending) > 0:
+            self.f.write("\n".join(self.pending) + "\n")
+            self.pending = []
+        self.f.flush()
+        if _UT_CONFIG_.log_fsync:
+            os.fsync(self.f.fileno())
+        self.last_flush_ts = time.time()
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.flusher is not None:
+            self.stop_flusher.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        self.f.close()
+        self.f = None
+
+    def iter_entries(self):
+        if self.f is not None:
+            self.flush()
+        for line in read_log_lines(self.fname):
+            yield load_entry(line, self.blob_store)
+
+    def iter_plain_text(self):
+        for entry in self.iter_entries():
+            yield entry.to_plain_text()
+
+    def write_plain_text(self, f_out):
+        for s in self.iter_plain_text():
+            f_out.write(s.encode("utf-8"))
 
     def to_plain_text(self):
-        s = ""
-        for entry in self.entry_list:
-            s += entry.to_plain_text()
-        return s
+        return "".join(self.iter_plain_text())
+
+# a last line without newline is a write cut short by a crash, skip it
+def read_log_lines(fpath):
+    with open(fpath, "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield line[:-1]
+
+def read_log_entries(fpath):
+    for line in read_log_lines(fpath):
+        yield json.loads(line)
 
+# the JSON array view of a log, as written by former versions; outputs
+# kept in the blob store are inlined again when blob_store is given
+def write_json_array(fpath, f_out, blob_store=None):
+    f_out.write("[\n")
+    i = 0
+    for line in read_log_lines(fpath):
+        if i > 0:
+            f_out.write(",\n")
+        if blob_store is not None and LogEntryResult.REF_SUFFIX in line:
+            entry = load_entry(line, blob_store)
+            entry.out = output_text(entry.out)
+            entry.err = output_text(entry.err)
+            line = entry.to_json()
+        f_out.write(line)
+        i += 1
+    if i == 0:
+        f_out.write("\n")
+    f_out.write("\n]\n")
@@ -1,5 +1,93 @@
+import os
 import sys
+import atexit
 import logging
+import threading
+import Queue
+from UtConfig import _UT_CONFIG_
+
+# Records are put on a queue by the calling thread and formatted and
+# written by a listener thread, so the sessions never wait for the
+# console. Pass arguments %-style, e.g. logger.debug("out:\n%s", out),
+# they are truncated to log_max_payload when queued and only formatted
+# if a handler takes the record. A full queue drops records instead of
+# blocking, the count is reported once there is room again.
+class UtQueueHandler(logging.Handler):
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    # truncated before queueing, a queued record must not hold on to a
+    # whole cmd output
+    def emit(self, record):
+        record.args = truncate_args(record.args)
+        self.listener.put(record)
+
+class UtQueueListener(object):
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.pid = None
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(_UT_CONFIG_.log_queue_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.serve,
+                                       name="UtQueueListener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        # a forked child, e.g. a worker job process, has no listener thread
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def serve(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped > 0:
+                dropped, self.dropped = self.dropped, 0
+                self.handle(logging.makeLogRecord({
+                    "name":record.name, "levelno":logging.WARNING,
+                    "levelname":"WARNING",
+                    "msg":"Logger: %d records dropped, queue full",
+                    "args":(dropped,)}))
+            self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    # drain the queue, records put after stop are lost
+    def stop(self):
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+def truncate(s):
+    size = _UT_CONFIG_.log_max_payload
+    if not isinstance(s, basestring) or size <= 0 or len(s) <= size:
+        return s
+    half = size / 2
+    return "{0}\n... {1} bytes omitted ...\n{2}".format(\
+           s[:half], len(s) - 2 * half, s[-half:])
+
+def truncate_args(args):
+    if isinstance(args, tuple):
+        return tuple([truncate(x) for x in args])
+    return args
 
 def set_logger():
     logger.setLevel(logging.DEBUG)
@@ -8,7 +96,9 @@ def set_logger():
     fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     formatter = logging.Formatter(fmt)
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    listener = UtQueueListener([ch])
+    logger.addHandler(UtQueueHandler(listener))
+    atexit.register(listener.stop)
 
 logger = logging.getLogger("UTS")
 set_logger()
@@ -3,11 +3,31 @@
 
 import os
 import json
+import time
+import atexit
+import smtplib
+import threading
+import Queue
 from email.mime.text import MIMEText
 from subprocess import Popen, PIPE
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
 
+# Notify config, only recipient is required:
+# {"recipient":"my.email@myemail.com", "sender":"notify@uts.com",
+#  "sendmail":["/usr/sbin/sendmail", "-t", "-oi"], "smtp":"host:port",
+#  "digest":false}
+# The mail is piped to the sendmail cmd, or sent to the SMTP server when
+# smtp is set. With digest, results are sent in one mail per
+# notify_digest_window seconds or notify_digest_max results.
 class UtNotify(object):
     RECIPIENT = "recipient"
+    SENDER = "sender"
+    SENDMAIL = "sendmail"
+    SMTP = "smtp"
+    DIGEST = "digest"
+    DEFAULT_SENDER = "notify@uts.com"
+    DEFAULT_SENDMAIL = ["/usr/sbin/sendmail", "-t", "-oi"]
 
     def __init__(self, json_notify_fpath):
         with open(json_notify_fpath, "r") as f:
@@ -16,6 +36,11 @@ class UtNotify(object):
         notify_data = json.loads(notify_str)
         self.validate_notify_data(notify_data, notify_str)
         self.recipient = notify_data[self.RECIPIENT]
+        self.sender = notify_data.get(self.SENDER, self.DEFAULT_SENDER)
+        self.sendmail_cmd = notify_data.get(self.SENDMAIL,
+                                            self.DEFAULT_SENDMAIL)
+        self.smtp = notify_data.get(self.SMTP, None)
+        self.digest = notify_data.get(self.DIGEST, False)
 
     def validate_notify_data(self, notify_data, notify_str):
         result = ""
@@ -24,16 +49,150 @@ class UtNotify(object):
             if name not in notify_data:
                 result += "Missing {0},\n".format(name)
 
+        sendmail_cmd = notify_data.get(self.SENDMAIL, self.DEFAULT_SENDMAIL)
+        if not isinstance(sendmail_cmd, list) or len(sendmail_cmd) == 0 or \
+           len([x for x in sendmail_cmd if not isinstance(x, basestring)]) > 0:
+            result += "sendmail should be a list of cmd arguments,\n"
+        smtp = notify_data.get(self.SMTP, "host:0")
+        if not isinstance(smtp, basestring) or \
+           not smtp.rpartition(":")[2].isdigit():
+            result += "smtp should be host:port,\n"
+        if not isinstance(notify_data.get(self.DIGEST, False), bool):
+            result += "digest should be true or false,\n"
+
         if result != "":
             result += "Notify config:\n{0}".format(notify_str)
             err = "Fail to read in Notify config:\n" + result
             raise Exception(err)
 
+    # mails to the same key can be sent in one digest
+    def digest_key(self):
+        return (self.recipient, self.sender, tuple(self.sendmail_cmd),
+                self.smtp)
+
     def sendmail(self, subject, msg_body):
         msg = MIMEText(msg_body)
-        msg["From"] = "notify@uts.com"
+        msg["From"] = self.sender
         msg["To"] = self.recipient
         msg["Subject"] = subject
-        p = Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=PIPE)
+        if self.smtp is not None:
+            host, sep, port = self.smtp.rpartition(":")
+            smtp = smtplib.SMTP(host, int(port))
+            try:
+                smtp.sendmail(self.sender, [self.recipient], msg.as_string())
+            finally:
+                smtp.quit()
+            return
+        p = Popen(self.sendmail_cmd, stdin=PIPE)
         p.communicate(msg.as_string())
+        if p.returncode != 0:
+            err = "{0} returned {1}".format(" ".join(self.sendmail_cmd),
+                                            p.returncode)
+            raise Exception(err)
+
+    # returns at once, the mail is sent by the notify queue
+    def post(self, subject, msg_body, passed=True):
+        notify_queue().put(self, subject, msg_body, passed)
+
+# Mails are sent by a background thread, so sessions never wait for the
+# MTA. Digest mails are held until their window ends or they reach
+# notify_digest_max results. A full queue blocks the caller, mails are
+# not dropped. Pending mails are sent at exit.
+class UtNotifyQueue(object):
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(_UT_CONFIG_.notify_queue_size)
+        # digest key -> [notify, first put time, [(subject, body, passed)]]
+        self.digests = {}
+        self.thread = threading.Thread(target=self.serve,
+                                       name="UtNotifyQueue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, notify, subject, msg_body, passed=True):
+        # a forked child has no sender thread
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        self.queue.put((notify, subject, msg_body, passed))
+
+    def serve(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.next_due())
+            except Queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if len(item) > 0:
+                self.add(*item)
+            self.send_digests()
+        self.send_digests(flush=True)
+
+    # seconds until the oldest digest is due, None waits for the next mail
+    def next_due(self):
+        if len(self.digests) == 0:
+            return None
+        first_ts = min([x[1] for x in self.digests.values()])
+        return max(0.0, first_ts + _UT_CONFIG_.notify_digest_window - \
+                        time.time())
+
+    def add(self, notify, subject, msg_body, passed):
+        if not notify.digest:
+            self.send(notify, subject, msg_body)
+            return
+        key = notify.digest_key()
+        if key not in self.digests:
+            self.digests[key] = [notify, time.time(), []]
+        self.digests[key][2].append((subject, msg_body, passed))
+
+    def send_digests(self, flush=False):
+        now = time.time()
+        for key in self.digests.keys():
+            notify, first_ts, mails = self.digests[key]
+            if flush or len(mails) >= _UT_CONFIG_.notify_digest_max or \
+               now - first_ts >= _UT_CONFIG_.notify_digest_window:
+                del self.digests[key]
+                self.send(notify, *format_digest(mails))
+
+    def send(self, notify, subject, msg_body):
+        try:
+            notify.sendmail(subject, msg_body)
+        except Exception as e:
+            logger.error("Notify: fail to send '%s' to %s, %s", subject,
+                         notify.recipient, e)
+
+    # send all pending mails, mails put after stop are lost
+    def stop(self):
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+def format_digest(mails):
+    failed = len([x for x in mails if not x[2]])
+    subject = "UTS digest, {0} results, {1} failed".format(len(mails),
+                                                           failed)
+    s = ""
+    for mail in mails:
+        s += mail[0] + "\n"
+    for mail in mails:
+        s += "\n{0}\n{1}\n{2}\n".format("=" * 72, mail[0], mail[1])
+    return subject, s
+
+_NOTIFY_QUEUE_ = None
+_NOTIFY_QUEUE_LOCK_ = threading.Lock()
 
+def notify_queue():
+    global _NOTIFY_QUEUE_
+    with _NOTIFY_QUEUE_LOCK_:
+        if _NOTIFY_QUEUE_ is None:
+            _NOTIFY_QUEUE_ = UtNotifyQueue()
+            atexit.register(_NOTIFY_QUEUE_.stop)
+    return _NOTIFY_QUEUE_
@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import re
+import json
+import heapq
 import datetime
 from UtScript import UtCmd
+from UtTiming import CmdTiming, CmdStats
+from UtConfig import _UT_CONFIG_
 
 class UtResult(object):
+    SLOWEST_CNT = 5
+    PERCENTILES = [50, 90, 99]
+    METRICS_JSON = "json"
+    METRICS_PROM = "prom"
+
     def __init__(self):
         self.start_ts = None
         self.end_ts = None
@@ -12,6 +23,17 @@ class UtResult(object):
         self.success = 0
         self.rc = None
         self.result = ""
+        # cmd executions are aggregated as they are added, memory does
+        # not grow with exec_cnt
+        self.timing_cnt = 0
+        self.phases = dict([(x, 0.0) for x in CmdTiming.PHASES])
+        # cmdline -> CmdStats
+        self.cmd_stats = {}
+        # min-heap of the SLOWEST_CNT slowest (total, seq, timing)
+        self.slowest = []
+        self.loads = []
+        # cmdline -> [hits, misses] of the cacheable cmds
+        self.caches = {}
 
     def set_total(self, total):
         self.total = total
@@ -19,12 +41,41 @@ class UtResult(object):
     def inc_success(self):
         self.success += 1
 
+    def add_timing(self, timing):
+        self.timing_cnt += 1
+        for phase in CmdTiming.PHASES:
+            self.phases[phase] += timing.phases[phase]
+        stats = self.cmd_stats.get(timing.cmdline)
+        if stats is None:
+            stats = self.cmd_stats[timing.cmdline] = CmdStats()
+        stats.add(timing)
+        item = (timing.total(), self.timing_cnt, timing)
+        if len(self.slowest) < self.SLOWEST_CNT:
+            heapq.heappush(self.slowest, item)
+        elif item[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def add_load(self, stats):
+        self.loads.append(stats)
+
+    def add_cache(self, cmdline, hit):
+        x = self.caches.setdefault(cmdline, [0, 0])
+        if hit:
+            x[0] += 1
+        else:
+            x[1] += 1
+
     def record_start_ts(self):
         self.start_ts = datetime.datetime.now()
 
     def record_end_ts(self):
         self.end_ts = datetime.datetime.now()
 
+    def duration(self):
+        if self.start_ts is None or self.end_ts is None:
+            return 0.0
+        return (self.end_ts - self.start_ts).total_seconds()
+
     def set_result(self, rc):
         self.rc = rc
         if rc == UtCmd.RC_OK:
@@ -84,5 +135,136 @@ class UtResult(object):
         s = "UT started on {0}, lasted for {1}, {2} passed.\n\n".format(\
             start_ts, interval, percent)
         s += self.run_report
+        if self.timing_cnt > 0:
+            s += "\n" + self.format_timing()
+        if len(self.loads) > 0:
+            s += "\n" + self.format_loads()
+        if len(self.caches) > 0:
+            s += "\n" + self.format_caches()
+        return s
+
+    def format_caches(self):
+        hits = sum([x[0] for x in self.caches.values()])
+        misses = sum([x[1] for x in self.caches.values()])
+        s = "Result cache, {0} hits, {1} misses:\n".format(hits, misses)
+        s += "{0:>6} {1:>6}  {2}\n".format("hits", "misses", "cmdline")
+        for cmdline in sorted(self.caches):
+            x = self.caches[cmdline]
+            s += "{0:>6} {1:>6}  {2}\n".format(x[0], x[1], cmdline)
+        return s
+
+    def format_loads(self):
+        s = "Load cmds:\n"
+        for stats in self.loads:
+            s += stats.format()
+        return s
+
+    def phase_totals(self):
+        return dict(self.phases)
+
+    # cmdline -> count, sum and the percentiles of its durations
+    def cmd_summaries(self, percentiles):
+        return dict([(x, self.cmd_stats[x].summary(percentiles)) \
+                     for x in self.cmd_stats])
+
+    def format_timing(self):
+        totals = self.phase_totals()
+        s = "Time spent in seconds, {0} cmd executions:\n".format(\
+            self.timing_cnt)
+        s += "  ".join(["{0} {1:.3f}".format(x, totals[x]) \
+                        for x in CmdTiming.PHASES]) + "\n"
+        s += "\nSlowest cmd executions:\n"
+        for total, seq, timing in sorted(self.slowest, reverse=True):
+            s += "{0:>9.3f}  {1}  {2}\n".format(total,
+                 timing.format_phases(), timing.cmdline)
+        s += "\nPer cmdline:\n"
+        s += "{0:>6} {1:>9} {2:>9} {3:>9} {4:>9}  {5}\n".format(\
+             "count", "total", "p50", "p90", "p99", "cmdline")
+        summaries = self.cmd_summaries(self.PERCENTILES)
+        for cmdline in sorted(summaries, key=lambda x: -summaries[x]["sum"]):
+            x = summaries[cmdline]
+            s += "{0:>6} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>9.3f}  "\
+                 "{5}\n".format(x["count"], x["sum"], x["p50"], x["p90"],
+                                x["p99"], cmdline)
         return s
 
+    def metrics(self, ses_id, host):
+        summaries = self.cmd_summaries(self.PERCENTILES)
+        cmds = []
+        for cmdline in sorted(summaries):
+            cmd = summaries[cmdline]
+            cmd["cmdline"] = cmdline
+            cmds.append(cmd)
+        return {"ses_id":ses_id, "host":host, "result":self.result == True,
+                "total":self.total, "success":self.success,
+                "duration":self.duration(), "phases":self.phase_totals(),
+                "cmds":cmds}
+
+    # Prometheus text format, for the node exporter textfile collector. The
+    # series are per host, each session replaces those of the one before.
+    def format_prom(self, metrics):
+        labels = 'host="{0}"'.format(prom_escape(metrics["host"]))
+        lines = []
+        def add(name, metric_type, help_str, samples):
+            lines.append("# HELP {0} {1}".format(name, help_str))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for suffix, extra, value in samples:
+                if extra != "":
+                    extra = "," + extra
+                lines.append("{0}{1}{{{2}{3}}} {4!r}".format(\
+                             name, suffix, labels, extra, float(value)))
+        add("uts_session_duration_seconds", "gauge",
+            "Duration of the UT session.", [("", "", metrics["duration"])])
+        add("uts_session_success", "gauge",
+            "1 if the UT session succeeded.",
+            [("", "", int(metrics["result"]))])
+        add("uts_session_cmds", "gauge", "Cmd executions of the session.",
+            [("", 'state="total"', metrics["total"]),
+             ("", 'state="success"', metrics["success"])])
+        add("uts_phase_seconds", "gauge",
+            "Time spent in each phase of the cmd executions.",
+            [("", 'phase="{0}"'.format(x), metrics["phases"][x]) \
+             for x in CmdTiming.PHASES])
+        samples = []
+        for cmd in metrics["cmds"]:
+            cmd_label = 'cmdline="{0}"'.format(prom_escape(cmd["cmdline"]))
+            for p in self.PERCENTILES:
+                samples.append(("", '{0},quantile="{1}"'.format(\
+                                cmd_label, p / 100.0),
+                                cmd["p{0}".format(p)]))
+            samples.append(("_sum", cmd_label, cmd["sum"]))
+            samples.append(("_count", cmd_label, cmd["count"]))
+        add("uts_cmd_seconds", "summary", "Duration of cmd executions.",
+            samples)
+        return "\n".join(lines) + "\n"
+
+    # Written next to the log unless metrics_dir is set, renamed into
+    # place so a collector never reads a partial file. The prom file is
+    # named after the host, a collector dir holds one file per host.
+    def export_metrics(self, ses_id, host, ses_path):
+        formats = _UT_CONFIG_.metrics_export
+        if len(formats) == 0:
+            return
+        path = _UT_CONFIG_.metrics_dir
+        if path == "":
+            path = ses_path
+        metrics = self.metrics(ses_id, host)
+        for fmt in formats:
+            if fmt == self.METRICS_JSON:
+                data = json.dumps(metrics) + "\n"
+            elif fmt == self.METRICS_PROM:
+                data = self.format_prom(metrics)
+            else:
+                err = "Unknown metrics format {0}".format(fmt)
+                raise Exception(err)
+            name = ses_id
+            if fmt == self.METRICS_PROM:
+                name = re.sub(r"[^\w.-]", "_", host)
+            fpath = os.path.join(path, "uts_{0}.{1}".format(name, fmt))
+            with open(fpath + ".tmp", "w") as f:
+                f.write(data)
+            os.rename(fpath + ".tmp", fpath)
+
+def prom_escape(s):
+    return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
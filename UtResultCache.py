@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
+
+# Outputs of cacheable cmds, kept in <root_path>/<result_cache_fname> and
+# keyed by host identity plus cmdline. An entry is a hit while younger
+# than the TTL of the cmd asking for it. Least recently used entries are
+# evicted once the outputs take more than result_cache_max_bytes. Only
+# successful executions are stored, a transient failure is never served.
+# Those wrote nothing to stderr, see UtCmd.check_result, only stdout is
+# kept, as the bytes read, and a hit replays it as is.
+class UtResultCache(object):
+    # a file of an older version is dropped, it is only a cache
+    SCHEMA_VERSION = 2
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, "
+        "host TEXT, cmdline TEXT, out BLOB, created REAL, "
+        "last_used REAL, size INTEGER)",
+        "CREATE INDEX IF NOT EXISTS results_last_used ON results "
+        "(last_used)"]
+
+    def __init__(self, fpath=None, max_bytes=None):
+        if fpath is None:
+            fpath = os.path.join(_UT_CONFIG_.root_path,
+                                 _UT_CONFIG_.result_cache_fname)
+        if max_bytes is None:
+            max_bytes = _UT_CONFIG_.result_cache_max_bytes
+        self.fpath = fpath
+        self.max_bytes = max_bytes
+        self.conn = None
+        # cmds of a parallel group share the cache
+        self.lock = threading.Lock()
+
+    # sessions of several worker processes share the file
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.fpath, timeout=60,
+                                        check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                version = self.conn.execute("PRAGMA user_version")\
+                                   .fetchone()[0]
+                if version != self.SCHEMA_VERSION:
+                    self.conn.execute("DROP TABLE IF EXISTS results")
+                    self.conn.execute("PRAGMA user_version = {0}".format(\
+                                      self.SCHEMA_VERSION))
+                for stmt in self.SCHEMA:
+                    self.conn.execute(stmt)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def key(self, host, cmdline):
+        return hashlib.sha1(u"{0}\0{1}".format(host, cmdline)\
+                            .encode("utf-8")).hexdigest()
+
+    # (out, age in seconds) of a fresh entry, or None
+    def get(self, host, cmdline, ttl, now=None):
+        if now is None:
+            now = time.time()
+        key = self.key(host, cmdline)
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT out, created FROM results "
+                               "WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] >= ttl:
+                return None
+            with conn:
+                conn.execute("UPDATE results SET last_used = ? "
+                             "WHERE key = ?", (now, key))
+        return str(row[0]), now - row[1]
+
+    def put(self, host, cmdline, out, now=None):
+        if now is None:
+            now = time.time()
+        if isinstance(out, unicode):
+            out = out.encode("utf-8")
+        size = len(out) + len(cmdline)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO results VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?)",
+                             (self.key(host, cmdline), host, cmdline,
+                              buffer(out), now, now, size))
+                self.evict(conn)
+
+    # least recently used first, until the rest fits in max_bytes
+    def evict(self, conn):
+        total = conn.execute("SELECT SUM(size) FROM results").fetchone()[0]
+        if total is None or total <= self.max_bytes:
+            return
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM results "
+                                      "ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            keys.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM results WHERE key = ?", keys)
+        logger.info("Result cache: evict %d entries", len(keys))
@@ -2,9 +2,17 @@
 # encoding: utf-8
 
 import sys
+import copy
 import json
+import uuid
+import select
 import paramiko
 from UtLogger import logger
+from UtShell import UtShell
+from UtUtil import OutputWindow, shell_quote, kill_remote
+from UtUtil import CmdTimeout, EXEC_TIMEOUT, CHANNEL_POLL_INTERVAL
+from UtTiming import CmdTiming, monotonic
+from UtConfig import _UT_CONFIG_
 
 class UtSSH(object):
     HOST_IP = "host_ip"
@@ -12,15 +20,31 @@ class UtSSH(object):
     USR_NAME = "username"
     USR_PWD = "password"
     KEY_FILE = "key_file"
+    SESSION_SHELL = "session_shell"
+    PIPELINE = "pipeline"
+    CMD_TIMEOUT = "cmd_timeout"
+    SESSION_TIMEOUT = "session_timeout"
+    BATCH_MARK = "UTS_CMD_"
+    PID_MARK = "UTS_PID_"
 
-    def __init__(self, json_config_fpath):
-        self.apply_json_config(json_config_fpath)
-        self.ssh = paramiko.SSHClient()
+    # ssh_config is the json config file path, or the loaded config dict
+    def __init__(self, ssh_config, pool=None):
+        if isinstance(ssh_config, dict):
+            self.apply_config(ssh_config, json.dumps(ssh_config))
+        else:
+            self.apply_json_config(ssh_config)
+        self.pool = pool
+        self.ssh = None
+        self.shell = None
+        self.deadline = None
 
     def apply_json_config(self, config_fpath):
         with open(config_fpath, "r") as f:
             config_str = f.read().rstrip()
         config = json.loads(config_str)
+        self.apply_config(config, config_str)
+
+    def apply_config(self, config, config_str):
         self.validate_input_config(config, config_str)
         self.host_ip = config[self.HOST_IP]
         self.host_port = config[self.HOST_PORT]
@@ -33,6 +57,11 @@ class UtSSH(object):
             self.key_file = config[self.KEY_FILE]
         else:
             self.key_file = ""
+        self.session_shell = config.get(self.SESSION_SHELL, False)
+        self.pipeline = config.get(self.PIPELINE, False)
+        # seconds, 0 is no limit
+        self.cmd_timeout = config.get(self.CMD_TIMEOUT, 0)
+        self.session_timeout = config.get(self.SESSION_TIMEOUT, 0)
 
     def validate_input_config(self, config, config_str):
         result = ""
@@ -54,6 +83,18 @@ class UtSSH(object):
             err = "SSH port should be in int format"
             raise Exception(err)
 
+        for name in [self.SESSION_SHELL, self.PIPELINE]:
+            if not isinstance(config.get(name, False), bool):
+                err = "SSH {0} should be true or false".format(name)
+                raise Exception(err)
+
+        for name in [self.CMD_TIMEOUT, self.SESSION_TIMEOUT]:
+            timeout = config.get(name, 0)
+            if isinstance(timeout, bool) or \
+               not isinstance(timeout, (int, float)) or timeout < 0:
+                err = "SSH {0} should be a number of seconds".format(name)
+                raise Exception(err)
+
     def ssh_detail(self):
         return "{0}@{1}:{2}".format(self.username, self.host_ip, self.host_port)
 
@@ -61,10 +102,16 @@ class UtSSH(object):
         s = self.ssh_detail() + " password " + self.password
         return s
 
-    def connect(self):
-        logger.info("SSH: connect {0}".format(self.ssh_detail()))
+    # identity of the target and credential, connections are shared
+    # between UtSSH objects with the same pool key
+    def pool_key(self):
+        return (self.host_ip, self.host_port, self.username, \
+                self.password, self.key_file)
+
+    def new_client(self):
+        logger.info("SSH: connect %s", self.ssh_detail())
         try:
-            ssh = self.ssh
+            ssh = paramiko.SSHClient()
             #avoid xxx not found in known_hosts
             ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             if self.key_file != "":
@@ -76,24 +123,271 @@ class UtSSH(object):
         except Exception as e:
             err = "SSH {0} failed, {1}".format(self.ssh_detail(), str(e))
             raise Exception(err)
+        ssh.get_transport().set_keepalive(_UT_CONFIG_.ssh_keepalive)
+        return ssh
+
+    def connect(self):
+        if self.session_timeout > 0:
+            self.deadline = monotonic() + self.session_timeout
+        if self.pool is not None:
+            self.ssh = self.pool.checkout(self)
+        else:
+            self.ssh = self.new_client()
+        if self.session_shell:
+            self.shell = UtShell(self.ssh.get_transport())
+
+    # Another connection to the same target without session shell, e.g. to
+    # spread load over transports. It keeps the session deadline and is
+    # closed by the caller.
+    def open_transport(self):
+        ssh = copy.copy(self)
+        ssh.pool = None
+        ssh.shell = None
+        ssh.ssh = self.new_client()
+        return ssh
 
     def close(self):
-        self.ssh.close()
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+        if self.ssh is None:
+            return
+        if self.pool is not None:
+            self.pool.checkin(self, self.ssh)
+        else:
+            self.ssh.close()
+        self.ssh = None
+
+    # monotonic time a cmd must end by, timeout in seconds overrides
+    # cmd_timeout, 0 is no limit. The session deadline applies to all cmds.
+    def cmd_deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.cmd_timeout
+        deadline = self.deadline
+        if timeout > 0:
+            deadline = min(deadline or float("inf"), monotonic() + timeout)
+        return deadline
+
+    # err read before the timeout is kept
+    def format_timeout(self, cmdline, err=""):
+        if err != "" and not err.endswith("\n"):
+            err += "\n"
+        return err + "Timeout running cmd {0}, SSH {1}".format(\
+               cmdline, self.ssh_detail())
+
+    # The cmd writes its pid first to stderr, to be killed on timeout
+    def mark_pid(self, cmdline):
+        return "echo {0}$$ >&2; {1}".format(self.PID_MARK, cmdline)
+
+    # returns the pid and err without the pid line
+    def split_pid(self, err):
+        if not err.startswith(self.PID_MARK):
+            return None, err
+        end = err.find("\n")
+        if end < 0:
+            return None, ""
+        return int(err[len(self.PID_MARK):end]), err[end+1:]
+
+    def kill(self, channel, err):
+        pid, err = self.split_pid(err)
+        if pid is not None:
+            kill_remote(self.ssh.get_transport(), pid)
+        channel.close()
+
+    # Read stdout and stderr as they arrive, a cmd filling up one of them
+    # never waits for the other to be read. on_chunk(chunk) is called for
+    # every stdout chunk, returning True stops reading. Raises CmdTimeout
+    # once the deadline is passed. Returns True if stopped by on_chunk.
+    def drain(self, channel, out, err, timing, deadline, on_chunk=None):
+        chunk_size = _UT_CONFIG_.stream_chunk_size
+        start = monotonic()
+        first_ts = None
+        stopped = False
+        while True:
+            has_data = False
+            if channel.recv_ready():
+                chunk = channel.recv(chunk_size)
+                out.append(chunk)
+                has_data = True
+                # on_chunk time is part of READ, see execute_stream
+                if first_ts is None:
+                    first_ts = monotonic()
+                if on_chunk is not None and on_chunk(chunk):
+                    logger.info("SSH: verdict settled, stop reading")
+                    # the pid mark was sent before any stdout
+                    while channel.recv_stderr_ready():
+                        err.append(channel.recv_stderr(chunk_size))
+                    stopped = True
+                    break
+            if channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(chunk_size))
+                has_data = True
+                if first_ts is None:
+                    first_ts = monotonic()
+            if has_data:
+                continue
+            # data arrives before the eof, check once more after it
+            if channel.eof_received or channel.closed:
+                if not channel.recv_ready() and \
+                   not channel.recv_stderr_ready():
+                    break
+                continue
+            wait = CHANNEL_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    timing.add_exec_read(start, first_ts)
+                    raise CmdTimeout("")
+            # stdout data and the eof wake up select, stderr is polled
+            select.select([channel], [], [], wait)
+        timing.add_exec_read(start, first_ts)
+        return stopped
 
-    def exec_cmd(self, cmdline):
-        logger.info("SSH: Run cmd '{0}'".format(cmdline))
+    def check_deadline(self, cmdline, deadline):
+        if deadline is not None and deadline <= monotonic():
+            raise CmdTimeout(cmdline)
+
+    # open/exec/read phases are added to timing when given. rc is
+    # EXEC_TIMEOUT for a cmd run past its deadline, see cmd_deadline.
+    def exec_cmd(self, cmdline, timing=None, timeout=None):
+        logger.info("SSH: Run cmd '%s'", cmdline)
+        if timing is None:
+            timing = CmdTiming(cmdline)
+        deadline = self.cmd_deadline(timeout)
         rc = True
         try:
+            self.check_deadline(cmdline, deadline)
+            if self.shell is not None:
+                status, out, err = self.shell.exec_cmd(cmdline, timing,
+                                                       deadline)
+            else:
+                out, err = self.exec_channel(cmdline, timing, deadline)
+        except CmdTimeout as e:
+            rc = EXEC_TIMEOUT
+            err = self.format_timeout(cmdline, e.err)
+            out = e.out
+        except Exception as e:
+            rc = False
+            err = "Fail to exec cmd {0}, {1}, SSH {2}".format(
+                     cmdline, str(e), self.ssh_detail())
+            out = err
+        logger.debug("SSH: exec_cmd rc %s", rc)
+        logger.debug("SSH: exec_cmd out:\n%s", out)
+        logger.debug("SSH: exec_cmd err:\n%s", err)
+        return rc, out, err
+
+    def exec_channel(self, cmdline, timing, deadline):
+        if deadline is not None:
+            cmdline = self.mark_pid(cmdline)
+        with timing.phase(CmdTiming.OPEN):
             stdin, stdout, stderr = self.ssh.exec_command(cmdline)
-            out = stdout.read()
-            err = stderr.read()
+        channel = stdout.channel
+        out, err = [], []
+        try:
+            self.drain(channel, out, err, timing, deadline)
+        except CmdTimeout:
+            self.kill(channel, "".join(err))
+            pid, err = self.split_pid("".join(err))
+            raise CmdTimeout(cmdline, "".join(out), err)
+        channel.close()
+        pid, err = self.split_pid("".join(err))
+        return "".join(out), err
+
+    # on_chunk(chunk) is called for every stdout chunk, returning True ends
+    # the command early and kills it like on timeout. Only a head/tail
+    # window of the output is returned.
+    def exec_cmd_stream(self, cmdline, on_chunk, timing=None, timeout=None):
+        logger.info("SSH: Stream cmd '%s'", cmdline)
+        if timing is None:
+            timing = CmdTiming(cmdline)
+        deadline = self.cmd_deadline(timeout)
+        rc = True
+        out = OutputWindow(_UT_CONFIG_.stream_window_size)
+        err = OutputWindow(_UT_CONFIG_.stream_window_size)
+        try:
+            self.check_deadline(cmdline, deadline)
+            with timing.phase(CmdTiming.OPEN):
+                stdin, stdout, stderr = self.ssh.exec_command(
+                    self.mark_pid(cmdline))
+            channel = stdout.channel
+            try:
+                # time spent in on_chunk is accounted by the caller
+                if self.drain(channel, out, err, timing, deadline,
+                              on_chunk):
+                    self.kill(channel, err.text())
+            except CmdTimeout:
+                self.kill(channel, err.text())
+                pid, err = self.split_pid(err.text())
+                raise CmdTimeout(cmdline, out.text(), err)
+            channel.close()
+            pid, err = self.split_pid(err.text())
+            out = out.text()
+        except CmdTimeout as e:
+            rc = EXEC_TIMEOUT
+            err = self.format_timeout(cmdline, e.err)
+            out = e.out
         except Exception as e:
             rc = False
             err = "Fail to exec cmd {0}, {1}, SSH {2}".format(
-                     cmdline, str(e), self.ssh_detail)
+                     cmdline, str(e), self.ssh_detail())
             out = err
-        logger.debug("SSH: exec_cmd rc {0}".format(rc))
-        logger.debug("SSH: exec_cmd out:\n{0}".format(out))
-        logger.debug("SSH: exec_cmd err:\n{0}".format(err))
+        logger.debug("SSH: exec_cmd_stream rc %s, out %d bytes, "\
+                     "err %d bytes", rc, len(out), len(err))
         return rc, out, err
 
+    # Run cmds in one remote call. Every cmd is followed by its own mark on
+    # stdout (with exit status) and stderr, the batch stops at the first
+    # cmd writing to stderr, same as running them one by one.
+    def frame_batch(self, cmdlines, mark):
+        if self.shell is not None:
+            # keep the shell state, same as single cmds in session shell
+            open_grp, close_grp = "{", "; }"
+        else:
+            open_grp, close_grp = "(", ")"
+        s = "__uts_ok=1\n__uts_err=$(mktemp) || __uts_ok=0\n"
+        for i, cmdline in enumerate(cmdlines):
+            cmd_mark = "{0}{1}".format(mark, i)
+            s += "if [ $__uts_ok = 1 ]; then\n"
+            s += "{0} eval {1}{2} </dev/null 2>\"$__uts_err\"\n".format(\
+                 open_grp, shell_quote(cmdline), close_grp)
+            s += "printf '\\n%s %d\\n' {0} $?\n".format(cmd_mark)
+            s += "cat \"$__uts_err\" >&2\n"
+            s += "printf '\\n%s\\n' {0} >&2\n".format(cmd_mark)
+            s += "[ -s \"$__uts_err\" ] && __uts_ok=0\n"
+            s += "fi\n"
+        s += "rm -f \"$__uts_err\"\n"
+        return s
+
+    def split_batch(self, cmd_cnt, mark, out, err):
+        exec_results = []
+        out_pos, err_pos = 0, 0
+        for i in xrange(cmd_cnt):
+            cmd_mark = "\n{0}{1}".format(mark, i)
+            out_end = out.find(cmd_mark + " ", out_pos)
+            err_end = err.find(cmd_mark + "\n", err_pos)
+            if out_end < 0 or err_end < 0:
+                break
+            exec_results.append((True, out[out_pos:out_end], \
+                                 err[err_pos:err_end]))
+            out_pos = out.find("\n", out_end + len(cmd_mark)) + 1
+            err_pos = err_end + len(cmd_mark) + 1
+        return exec_results
+
+    # returns (rc, out, err) of each cmd that has been run, the batch is
+    # given cmd_timeout for each of its cmds. On timeout the cmds done are
+    # returned, followed by the timeout of the cmd running.
+    def exec_batch(self, cmdlines, timing=None):
+        mark = self.BATCH_MARK + uuid.uuid4().hex + "_"
+        rc, out, err = self.exec_cmd(self.frame_batch(cmdlines, mark), timing,
+                                     self.cmd_timeout * len(cmdlines))
+        if rc == False:
+            return [(rc, out, err)]
+        exec_results = self.split_batch(len(cmdlines), mark, out, err)
+        if rc == EXEC_TIMEOUT:
+            if len(exec_results) < len(cmdlines):
+                cmdline = cmdlines[len(exec_results)]
+                exec_results.append((rc, "", self.format_timeout(cmdline)))
+            return exec_results
+        if len(exec_results) == 0:
+            return [(False, out, err)]
+        return exec_results
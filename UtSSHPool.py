@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+import threading
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
+
+# Connections shared by sessions of one worker process. Idle connections
+# are kept per pool key (target + credential), checked before reuse and
+# closed once idle longer than idle_timeout. At most max_per_host
+# connections, idle or in use, are open to one host:port.
+class UtSSHPool(object):
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        if max_per_host is None:
+            max_per_host = _UT_CONFIG_.ssh_pool_max_per_host
+        if idle_timeout is None:
+            idle_timeout = _UT_CONFIG_.ssh_pool_idle_timeout
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.idle = {}
+        self.open_cnt = {}
+
+    def host_key(self, pool_key):
+        return pool_key[:2]
+
+    def is_healthy(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def checkout(self, ssh):
+        key = ssh.pool_key()
+        host = self.host_key(key)
+        to_close, reuse = [], None
+        with self.cond:
+            while True:
+                to_close += self.pop_expired()
+                idle_list = self.idle.get(key, [])
+                if len(idle_list) > 0:
+                    client, ts = idle_list.pop()
+                    if self.is_healthy(client):
+                        reuse = client
+                        break
+                    self.dec_open(host)
+                    to_close.append(client)
+                    continue
+                if self.open_cnt.get(host, 0) < self.max_per_host:
+                    self.open_cnt[host] = self.open_cnt.get(host, 0) + 1
+                    break
+                # make room with an idle connection of another user
+                victim = self.pop_idle_of_host(host)
+                if victim is not None:
+                    to_close.append(victim)
+                    continue
+                self.cond.wait()
+        self.close_clients(to_close)
+        if reuse is not None:
+            logger.info("SSH pool: reuse %s", ssh.ssh_detail())
+            return reuse
+        try:
+            return ssh.new_client()
+        except Exception:
+            with self.cond:
+                self.dec_open(host)
+            raise
+
+    def checkin(self, ssh, client):
+        key = ssh.pool_key()
+        healthy = self.is_healthy(client)
+        with self.cond:
+            if healthy:
+                self.idle.setdefault(key, []).append((client, time.time()))
+                self.cond.notify_all()
+            else:
+                self.dec_open(self.host_key(key))
+        if not healthy:
+            client.close()
+
+    def evict_idle(self):
+        with self.cond:
+            to_close = self.pop_expired()
+        self.close_clients(to_close)
+
+    # expired connections are otherwise only closed by a checkout, a
+    # process without new sessions would keep them open
+    def start_reaper(self, interval=None):
+        if interval is None:
+            interval = max(self.idle_timeout / 2.0, 1.0)
+        def reap():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.evict_idle()
+                except Exception as e:
+                    logger.warning("SSH pool: evict failed, %s", e)
+        thread = threading.Thread(target=reap, name="UtSSHPoolReaper")
+        thread.daemon = True
+        thread.start()
+
+    def close_all(self):
+        with self.cond:
+            to_close = []
+            for key, idle_list in self.idle.items():
+                for client, ts in idle_list:
+                    self.dec_open(self.host_key(key))
+                    to_close.append(client)
+            self.idle = {}
+        self.close_clients(to_close)
+
+    # below helpers are called with self.cond held
+    def dec_open(self, host):
+        self.open_cnt[host] -= 1
+        if self.open_cnt[host] == 0:
+            del self.open_cnt[host]
+        self.cond.notify_all()
+
+    def pop_expired(self):
+        expired, now = [], time.time()
+        for key, idle_list in self.idle.items():
+            remain = []
+            for client, ts in idle_list:
+                if now - ts > self.idle_timeout:
+                    self.dec_open(self.host_key(key))
+                    expired.append(client)
+                else:
+                    remain.append((client, ts))
+            if len(remain) > 0:
+                self.idle[key] = remain
+            else:
+                del self.idle[key]
+        return expired
+
+    def pop_idle_of_host(self, host):
+        for key, idle_list in self.idle.items():
+            if self.host_key(key) == host and len(idle_list) > 0:
+                client, ts = idle_list.pop(0)
+                self.dec_open(host)
+                return client
+        return None
+
+    def close_clients(self, clients):
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning("SSH pool: close failed, %s", e)
@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
 import re
 import json
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+from UtLog import LogEntryAction, LogEntryResult
 from UtLogger import logger
+from UtTiming import CmdTiming, LoadStats, monotonic
+from UtScriptCache import UtScriptCache, gc_paused
+from UtResultCache import UtResultCache
+from UtUtil import EXEC_TIMEOUT
+from UtConfig import _UT_CONFIG_
+
+# Compiled patterns shared by all cmds, generated scripts repeat a few
+# patterns over thousands of cmds
+_REGEX_CACHE_ = {}
+REGEX_CACHE_MAX = 10000
 
 class CmdRegex(object):
     TYPE = "type"
@@ -14,12 +30,18 @@ class CmdRegex(object):
     OPER_AND = "and"
     OPER_OR = "or"
 
-    def __init__(self, regex_data):
-        self.validate_regex_data(regex_data)
+    # validated data, e.g. from the script cache, compiles the pattern on
+    # first use
+    def __init__(self, regex_data, validated=False):
+        if not validated:
+            self.validate_regex_data(regex_data)
         if regex_data[self.TYPE] == self.TYPE_PTN:
             self.is_operand = True
             self.ptn = regex_data[self.VALUE]
-            self.result = False
+            self.regex = None
+            if not validated:
+                self.regex = self.validate_regex_pattern(self.ptn)
+            self.idx = None
         else:
             self.is_operand = False
             self.val = regex_data[self.VALUE]
@@ -48,40 +70,34 @@ class CmdRegex(object):
             raise Exception(err)
 
         value = regex_data[self.VALUE]
-        if data_type == self.TYPE_PTN:
-            self.validate_regex_pattern(value)
-        else:
+        if data_type != self.TYPE_PTN:
             defined_values = [self.OPER_NOT, self.OPER_AND, self.OPER_OR]
             if value not in defined_values:
                 err = "CMD regex operator {0} not supported".format(value)
                 raise Exception(err)
 
     def validate_regex_pattern(self, ptn):
+        regex = _REGEX_CACHE_.get(ptn)
+        if regex is not None:
+            return regex
         try:
-            re.compile(ptn)
+            regex = re.compile(ptn)
         except Exception as e:
             err = "Compile regex pattern failed, {0}, pattern:\n".format(str(e))
             err += ptn
             raise Exception(err)
+        if len(_REGEX_CACHE_) >= REGEX_CACHE_MAX:
+            _REGEX_CACHE_.clear()
+        _REGEX_CACHE_[ptn] = regex
+        return regex
 
-    def match_ptn(self, s):
-        rc = re.search(self.ptn, s)
-        if rc is None:
-            self.result = False
-        else:
-            self.result = True
-        logger.info("Match '{0}', result {1}".format(self.ptn, self.result))
+    def get_regex(self):
+        if self.regex is None:
+            self.regex = self.validate_regex_pattern(self.ptn)
+        return self.regex
 
-    def operate(self, x1, x2):
-        if self.val == self.OPER_NOT:
-            result = not x1
-        elif self.val == self.OPER_AND:
-            result = x1 and x2
-        elif self.val == self.OPER_OR:
-            result = x1 or x2
-        logger.info("Operator {0}, x1 {1}, x2 {2}, result {3}".format(\
-                    self.val, x1, x2, result))
-        return result
+    def match_ptn(self, s):
+        return self.get_regex().search(s) is not None
 
     def notation(self):
         if self.is_operand:
@@ -95,19 +111,252 @@ class CmdRegex(object):
         else:
             return "??"
 
+class CmdRegexExpr(object):
+    def __init__(self, cmd_regex, x1=None, x2=None):
+        self.cmd_regex = cmd_regex
+        self.x1 = x1
+        self.x2 = x2
+
+    # match(cmd_regex) gives the operand result, results holds one slot
+    # per operand, None means skipped. Walks the tree with an explicit
+    # stack, a chain of thousands of operators nests as deep.
+    def evaluate(self, match, results):
+        value = None
+        stack = [(self, False)]
+        while len(stack) > 0:
+            expr, x1_done = stack.pop()
+            cmd_regex = expr.cmd_regex
+            if cmd_regex.is_operand:
+                value = match(cmd_regex)
+                results[cmd_regex.idx] = value
+            elif not x1_done:
+                stack.append((expr, True))
+                stack.append((expr.x1, False))
+            elif cmd_regex.val == CmdRegex.OPER_NOT:
+                value = not value
+            elif cmd_regex.val == CmdRegex.OPER_AND and not value:
+                value = False
+            elif cmd_regex.val == CmdRegex.OPER_OR and value:
+                value = True
+            else:
+                # the result is the one of the right hand side
+                stack.append((expr.x2, False))
+        return value
+
+    # Three-valued evaluation for partial output, None while unknown.
+    # An operand not matched yet may still match later on.
+    def settle(self, matched):
+        value = None
+        # (expr, step, x1), step 0 settles x1, 1 x2, 2 combines them
+        stack = [(self, 0, None)]
+        while len(stack) > 0:
+            expr, step, x1 = stack.pop()
+            cmd_regex = expr.cmd_regex
+            if cmd_regex.is_operand:
+                value = None
+                if matched[cmd_regex.idx]:
+                    value = True
+            elif step == 0:
+                stack.append((expr, 1, None))
+                stack.append((expr.x1, 0, None))
+            elif cmd_regex.val == CmdRegex.OPER_NOT:
+                if value is not None:
+                    value = not value
+            elif step == 1:
+                stack.append((expr, 2, value))
+                stack.append((expr.x2, 0, None))
+            else:
+                value = settle_binary(cmd_regex.val, x1, value)
+        return value
+
+def settle_binary(oper, x1, x2):
+    if oper == CmdRegex.OPER_AND:
+        if x1 == False or x2 == False:
+            return False
+        elif x1 == True and x2 == True:
+            return True
+    elif oper == CmdRegex.OPER_OR:
+        if x1 == True or x2 == True:
+            return True
+        elif x1 == False and x2 == False:
+            return False
+    return None
+
+# Literal patterns sharing a leading prefix, e.g. a family of error
+# codes, are searched in one pass by a single alternation: re factors
+# out the common prefix and skips to it like for one literal. Once some
+# of them are found, the rest is searched from there by an alternation
+# of the pending ones only. The other patterns keep their own search.
+class CmdRegexLiterals(object):
+    def __init__(self, operands):
+        # ptn -> operands with that pattern
+        self.literals = {}
+        for cmd_regex in operands:
+            self.literals.setdefault(cmd_regex.ptn, []).append(cmd_regex)
+        # compiled on first scan, like the patterns of a cached script
+        self.regex = None
+
+    def compile(self, ptns):
+        return re.compile("|".join([re.escape(ptn) for ptn in ptns]))
+
+    # idx of the operands found in s
+    def scan(self, s):
+        if self.regex is None:
+            self.regex = self.compile(self.literals.keys())
+        found, pending, pos = set(), self.literals.keys(), 0
+        regex = self.regex
+        while len(pending) > 0:
+            m = regex.search(s, pos)
+            if m is None:
+                break
+            pos, remain = m.start(), []
+            for ptn in pending:
+                operands = self.literals[ptn]
+                if operands[0].get_regex().match(s, pos) is None:
+                    remain.append(ptn)
+                    continue
+                for cmd_regex in operands:
+                    found.add(cmd_regex.idx)
+            if len(remain) < len(pending) and len(remain) > 0:
+                # re caches the compiled subsets, bounded
+                regex = self.compile(remain)
+            pending, pos = remain, pos + 1
+        return found
+
+class CmdRegexMatcher(object):
+    META_CHARS = set(".^$*+?{}[]\\|()")
+    PREFIX_LEN = 4
+    # two literals in one pass already beat two searches, see
+    # bench_regex.py
+    MIN_LITERALS = 2
+
+    def __init__(self, operands):
+        groups = {}
+        for cmd_regex in operands:
+            ptn = cmd_regex.ptn
+            if len(ptn) >= self.PREFIX_LEN and self.is_literal(ptn):
+                groups.setdefault(ptn[:self.PREFIX_LEN], []).append(cmd_regex)
+        # operand idx -> CmdRegexLiterals
+        self.literals = {}
+        for group in groups.values():
+            if len(set([x.ptn for x in group])) < self.MIN_LITERALS:
+                continue
+            literals = CmdRegexLiterals(group)
+            for cmd_regex in group:
+                self.literals[cmd_regex.idx] = literals
+
+    # non-ASCII patterns are matched by re on their own, as before
+    def is_literal(self, ptn):
+        for c in ptn:
+            if c in self.META_CHARS or ord(c) > 127:
+                return False
+        return True
+
+    def is_useful(self):
+        return len(self.literals) > 0
+
+    # match(cmd_regex) for the expression tree, a group of literals is
+    # scanned once the first of them is asked for
+    def match_func(self, s):
+        found = {}
+        def match(cmd_regex):
+            literals = self.literals.get(cmd_regex.idx)
+            if literals is None:
+                return cmd_regex.match_ptn(s)
+            if literals not in found:
+                found[literals] = literals.scan(s)
+            return cmd_regex.idx in found[literals]
+        return match
+
+# Feed command output chunk by chunk. Each search covers the new chunk
+# plus an overlap carried over from the previous one, so a match longer
+# than the overlap may be missed when it spans chunks. The carry keeps
+# one char before the searched text, start, so that ^ and lookbehinds
+# see the real context rather than the start of a string. A match
+# reaching the end of the text so far may only hold there, e.g. through
+# $, it is settled on the next chunk or at the end of the output.
+class CmdRegexStream(object):
+    OVERLAP = 4096
+
+    def __init__(self, regex_grp):
+        self.regex_grp = regex_grp
+        self.matched = [False] * len(regex_grp.operands)
+        self.pending = list(regex_grp.operands)
+        self.carry = ""
+        self.start = 0
+        self.verdict = None
+
+    def feed(self, chunk):
+        if self.regex_grp.expr is None or len(self.pending) == 0:
+            return self.verdict is not None
+
+        s = self.carry + chunk
+        remain, hold = [], len(s)
+        for cmd_regex in self.pending:
+            m = cmd_regex.get_regex().search(s, self.start)
+            if m is not None and m.end() < len(s) - 1:
+                self.matched[cmd_regex.idx] = True
+                continue
+            if m is not None:
+                hold = min(hold, m.start())
+            remain.append(cmd_regex)
+        if len(remain) != len(self.pending):
+            self.verdict = self.regex_grp.expr.settle(self.matched)
+        self.pending = remain
+        self.set_carry(s, hold)
+        return self.verdict is not None
+
+    # keep the carry starting at a line boundary where possible, and
+    # before any match held back
+    def set_carry(self, s, hold):
+        start = len(s) - self.OVERLAP
+        if start > self.start:
+            pos = s.find("\n", start - 1)
+            if pos >= 0:
+                start = pos + 1
+            # a held match longer than the overlap is given up
+            start = max(min(start, hold), len(s) - 2 * self.OVERLAP)
+        if start <= self.start:
+            self.carry = s
+            return
+        self.carry = s[start-1:]
+        self.start = 1
+
+    def finish(self):
+        if self.regex_grp.expr is not None:
+            for cmd_regex in self.pending:
+                if cmd_regex.get_regex().search(self.carry, self.start) \
+                   is not None:
+                    self.matched[cmd_regex.idx] = True
+            self.pending = []
+        return self.regex_grp.report(list(self.matched))
+
 class CmdRegexGrp(object):
-    def __init__(self, regex_list):
+    RESULT_SKIP = "SKIP"
+
+    def __init__(self, regex_list, validated=False):
         self.raw_regex_data = regex_list
+        self.regex_inorder = []
+        self.operands = []
         if len(regex_list) == 0:
             self.regex_rpn = []
+            self.expr = None
+            self.matcher = None
             return
 
-        self.regex_inorder = []
         for regex_data in regex_list:
-            cmd_regex = CmdRegex(regex_data)
+            cmd_regex = CmdRegex(regex_data, validated)
+            if cmd_regex.is_operand:
+                cmd_regex.idx = len(self.operands)
+                self.operands.append(cmd_regex)
             self.regex_inorder.append(cmd_regex)
         self.regex_rpn = self.transform_to_rpn(self.regex_inorder)
-        self.validate_regex_list()
+        if not validated:
+            self.validate_regex_list()
+        self.expr = self.compile_expr(self.regex_rpn)
+        self.matcher = CmdRegexMatcher(self.operands)
+        if not self.matcher.is_useful():
+            self.matcher = None
 
     # RPN - Reverse Polish Notation
     def transform_to_rpn(self, list_in):
@@ -151,24 +400,50 @@ class CmdRegexGrp(object):
             err += "Regex group:\n{0}".format(self.raw_regex_data)
             raise Exception(err)
 
-    def evaluate(self, s):
-        stack = [True]
-        results = []
-        for cmd_regex in self.regex_rpn:
+    # Build the expression tree once, operands are evaluated lazily so
+    # AND/OR skip the right hand side once the result is settled
+    def compile_expr(self, regex_rpn):
+        stack = []
+        for cmd_regex in regex_rpn:
             if cmd_regex.is_operand:
-                cmd_regex.match_ptn(s)
-                stack.append(cmd_regex.result)
-                results.append(cmd_regex.result)
+                stack.append(CmdRegexExpr(cmd_regex))
             elif cmd_regex.binary:
-                x1 = stack.pop()
                 x2 = stack.pop()
-                x3 = cmd_regex.operate(x1, x2)
-                stack.append(x3)
+                x1 = stack.pop()
+                stack.append(CmdRegexExpr(cmd_regex, x1, x2))
             else:
                 x1 = stack.pop()
-                x2 = cmd_regex.operate(x1, None)
-                stack.append(x2)
-        if stack[-1] == True:
+                stack.append(CmdRegexExpr(cmd_regex, x1))
+        return stack[-1]
+
+    def evaluate(self, s):
+        if self.expr is None:
+            return ""
+
+        if self.matcher is not None:
+            match = self.matcher.match_func(s)
+        else:
+            match = lambda x: x.match_ptn(s)
+        results = [None] * len(self.operands)
+        result = self.expr.evaluate(match, results)
+        logger.debug("Evaluate regex group, result %s", result)
+        return self.format_evaluation_err(result, results)
+
+    def stream(self):
+        return CmdRegexStream(self)
+
+    # report on results gathered elsewhere, e.g. from a stream
+    def report(self, matched):
+        if self.expr is None:
+            return ""
+
+        results = [None] * len(self.operands)
+        result = self.expr.evaluate(lambda x: matched[x.idx], results)
+        logger.debug("Evaluate regex group, result %s", result)
+        return self.format_evaluation_err(result, results)
+
+    def format_evaluation_err(self, result, results):
+        if result == True:
             return ""
 
         err = "REGEX evaluation failed,\n"
@@ -178,30 +453,77 @@ class CmdRegexGrp(object):
             if cmd_regex.is_operand:
                 err += (cmd_regex.ptn + "\n")
         return err
-    
+
     def format_evaluation_result(self, results):
-        i, s = 0, ""
+        s = ""
         for cmd_regex in self.regex_inorder:
-            if cmd_regex.is_operand:
-                s += str(results[i])
-                i += 1
-            else:
+            if not cmd_regex.is_operand:
                 s += cmd_regex.notation()
+            elif results[cmd_regex.idx] is None:
+                s += self.RESULT_SKIP
+            else:
+                s += str(results[cmd_regex.idx])
             s += " "
         return s.strip() + "\n"
 
+# Load mode of a cmd, e.g. {"concurrency":8, "rate":100, "transports":2}:
+# its exec_cnt iterations are issued by concurrency workers spread over
+# transports connections, at most rate iterations per second when set
+class CmdLoad(object):
+    CONCURRENCY = "concurrency"
+    RATE = "rate"
+    TRANSPORTS = "transports"
+
+    def __init__(self, load_data):
+        self.validate_load_data(load_data)
+        self.concurrency = load_data.get(self.CONCURRENCY, 1)
+        self.rate = load_data.get(self.RATE, None)
+        # a worker uses one transport
+        self.transports = min(load_data.get(self.TRANSPORTS, 1),
+                              self.concurrency)
+
+    def validate_load_data(self, load_data):
+        if not isinstance(load_data, dict):
+            err = "CMD load should be a dict:\n{0}".format(load_data)
+            raise Exception(err)
+        for name in [self.CONCURRENCY, self.TRANSPORTS]:
+            value = load_data.get(name, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or \
+               value <= 0:
+                err = "CMD load {0} should be an int larger than 0:\n{1}"\
+                      .format(name, load_data)
+                raise Exception(err)
+        rate = load_data.get(self.RATE, 1)
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or \
+           rate <= 0:
+            err = "CMD load rate should be a number larger than 0:\n{0}"\
+                  .format(load_data)
+            raise Exception(err)
+
 class UtCmd(object):
     CMDLINE = "cmdline"
     EXEC_CNT = "exec_cnt"
     RETRY = "retry"
     REGEX = "regex"
+    STREAM = "stream"
+    STOP_EARLY = "stop_early"
+    SETUP = "setup"
+    TIMEOUT = "timeout"
+    CACHE_TTL = "cache_ttl"
+    ID = "id"
+    AFTER = "after"
+    PARALLEL = "parallel"
+    LOAD = "load"
 
     RC_OK = 0
     RC_CMD_FAIL = 1
     RC_REGEX_FAIL = 2
+    RC_TIMEOUT = 3
 
-    def __init__(self, cmd_data):
-        self.validate_cmd_data(cmd_data)
+    # validated is set for data checked before, e.g. from the script cache
+    def __init__(self, cmd_data, validated=False):
+        if not validated:
+            self.validate_cmd_data(cmd_data)
         self.cmdline = cmd_data[self.CMDLINE]
         if self.EXEC_CNT in cmd_data:
             self.exec_cnt = cmd_data[self.EXEC_CNT]
@@ -212,9 +534,23 @@ class UtCmd(object):
         else:
             self.retry = 0
         if self.REGEX in cmd_data:
-            self.regex_grp = CmdRegexGrp(cmd_data[self.REGEX])
+            self.regex_grp = CmdRegexGrp(cmd_data[self.REGEX], validated)
         else:
             self.regex_grp = CmdRegexGrp(regex_list=[])
+        self.stream = cmd_data.get(self.STREAM, False)
+        self.stop_early = cmd_data.get(self.STOP_EARLY, False)
+        self.setup = cmd_data.get(self.SETUP, False)
+        # seconds, None is the cmd_timeout of the SSH config
+        self.timeout = cmd_data.get(self.TIMEOUT, None)
+        # seconds an output of a read-only cmd is served from the result
+        # cache, None is not cacheable
+        self.cache_ttl = cmd_data.get(self.CACHE_TTL, None)
+        self.cmd_id = cmd_data.get(self.ID, None)
+        self.after = cmd_data.get(self.AFTER, [])
+        self.parallel = cmd_data.get(self.PARALLEL, None)
+        self.load = None
+        if self.LOAD in cmd_data:
+            self.load = CmdLoad(cmd_data[self.LOAD])
 
     def validate_cmd_data(self, cmd_data):
         result = ""
@@ -242,74 +578,725 @@ class UtCmd(object):
                 err = "CMD retry should be in int format:\n{0}".format(cmd_data)
                 raise Exception(err)
 
-    def execute(self, ssh):
-        logger.info("CMD: Execute cmd '{0}'".format(self.cmdline))
-        rc, out, err = ssh.exec_cmd(self.cmdline)
+        for name in [self.STREAM, self.STOP_EARLY, self.SETUP]:
+            if name in cmd_data and not isinstance(cmd_data[name], bool):
+                err = "CMD {0} should be true or false:\n{1}".format(\
+                      name, cmd_data)
+                raise Exception(err)
+
+        for name in [self.TIMEOUT, self.CACHE_TTL]:
+            if name not in cmd_data:
+                continue
+            value = cmd_data[name]
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, float)) or value <= 0:
+                err = "CMD {0} should be seconds larger than 0:\n{1}"\
+                      .format(name, cmd_data)
+                raise Exception(err)
+
+        # a cached output is a whole one, and a setup cmd is run for its
+        # effect on the connection
+        if self.CACHE_TTL in cmd_data:
+            for name in [self.STREAM, self.SETUP, self.LOAD]:
+                if cmd_data.get(name):
+                    err = "CMD cache_ttl does not go with {0}:\n{1}"\
+                          .format(name, cmd_data)
+                    raise Exception(err)
+
+        for name in [self.ID, self.PARALLEL]:
+            if name in cmd_data and \
+               not isinstance(cmd_data[name], basestring):
+                err = "CMD {0} should be a string:\n{1}".format(\
+                      name, cmd_data)
+                raise Exception(err)
+
+        if self.AFTER in cmd_data:
+            after = cmd_data[self.AFTER]
+            if not isinstance(after, list) or \
+               len([x for x in after if not isinstance(x, basestring)]) > 0:
+                err = "CMD after should be a list of cmd id:\n{0}".format(\
+                      cmd_data)
+                raise Exception(err)
+
+        # an iteration is one sample of the load, it is not retried
+        if self.LOAD in cmd_data:
+            for name in [self.RETRY, self.PARALLEL, self.SETUP]:
+                if cmd_data.get(name):
+                    err = "CMD load does not go with {0}:\n{1}".format(\
+                          name, cmd_data)
+                    raise Exception(err)
+
+    def execute(self, ssh, timing=None):
+        logger.info("CMD: Execute cmd '%s'", self.cmdline)
+        if timing is None:
+            timing = CmdTiming(self.cmdline)
+        if self.stream:
+            return self.execute_stream(ssh, timing)
+        rc, out, err = ssh.exec_cmd(self.cmdline, timing, self.timeout)
+        return self.check_result(rc, out, err, timing)
+
+    def check_result(self, rc, out, err, timing=None):
+        if rc == EXEC_TIMEOUT:
+            logger.info("CMD: Execute timed out")
+            return self.RC_TIMEOUT, out, err
         if rc == False or len(err) > 0:
-            logger.info("CMD: Execute return {0}".format(rc))
+            logger.info("CMD: Execute return %s", rc)
             return self.RC_CMD_FAIL, out, err
         logger.info("CMD: Evaluate Regex Group, if any")
-        err = self.regex_grp.evaluate(out)
+        if timing is None:
+            timing = CmdTiming(self.cmdline)
+        with timing.phase(CmdTiming.REGEX):
+            err = self.regex_grp.evaluate(out)
         if err != "":
             rc = self.RC_REGEX_FAIL
         else:
             rc = self.RC_OK
         return rc, out, err
 
+    # Regex group is fed while the output arrives, only a head/tail window
+    # of the output is kept for the log and report
+    def execute_stream(self, ssh, timing):
+        regex_stream = self.regex_grp.stream()
+        feed_time = [0.0]
+        def on_chunk(chunk):
+            start = monotonic()
+            settled = regex_stream.feed(chunk)
+            feed_time[0] += monotonic() - start
+            return settled and self.stop_early
+        rc, out, err = ssh.exec_cmd_stream(self.cmdline, on_chunk, timing,
+                                           self.timeout)
+        # the chunks are evaluated while being read
+        timing.add(CmdTiming.READ, -feed_time[0])
+        timing.add(CmdTiming.REGEX, feed_time[0])
+        if rc == EXEC_TIMEOUT:
+            logger.info("CMD: Execute timed out")
+            return self.RC_TIMEOUT, out, err
+        if rc == False or len(err) > 0:
+            logger.info("CMD: Execute return %s", rc)
+            return self.RC_CMD_FAIL, out, err
+        with timing.phase(CmdTiming.REGEX):
+            err = regex_stream.finish()
+        if err != "":
+            rc = self.RC_REGEX_FAIL
+        else:
+            rc = self.RC_OK
+        return rc, out, err
+
+    # cmds run once with nothing to evaluate can share one remote call
+    def is_batchable(self):
+        return self.exec_cnt == 1 and self.retry == 0 and \
+               not self.stream and self.regex_grp.expr is None and \
+               self.parallel is None and self.timeout is None and \
+               self.load is None and self.cache_ttl is None
+
+# Collects log entries and successes of a cmd run in a parallel group,
+# they are replayed into the session in script order once the group ends.
+# Timings go straight to result under lock, their order does not matter,
+# and are dropped without result.
+class CmdRecorder(object):
+    def __init__(self, result=None, lock=None):
+        self.result = result
+        self.lock = lock
+        self.entry_list = []
+        self.success = 0
+        self.caches = []
+        self.rc = None
+        self.out = ""
+        self.err = ""
+
+    def add_action_entry(self, desc):
+        self.entry_list.append(LogEntryAction(desc))
+
+    def add_result_entry(self, rc, out, err, cached=None):
+        self.entry_list.append(LogEntryResult(rc, out, err, cached))
+
+    def inc_success(self):
+        self.success += 1
+
+    def add_cache(self, cmdline, hit):
+        self.caches.append((cmdline, hit))
+
+    def add_timing(self, timing):
+        if self.result is not None:
+            with self.lock:
+                self.result.add_timing(timing)
+
+    def replay(self, log, result):
+        for entry in self.entry_list:
+            log.add_entry(entry)
+        for i in xrange(self.success):
+            result.inc_success()
+        for cmdline, hit in self.caches:
+            result.add_cache(cmdline, hit)
+
+# the cached cmd lists depend on the classes above
+_SCRIPT_VERSION_ = None
+
+def script_version():
+    global _SCRIPT_VERSION_
+    if _SCRIPT_VERSION_ is None:
+        fpath = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        with open(fpath, "rb") as f:
+            _SCRIPT_VERSION_ = hashlib.sha1(f.read()).hexdigest()
+    return _SCRIPT_VERSION_
+
+# a JSON array script starts with "[", anything else is JSON Lines
+def is_json_lines(fpath):
+    with open(fpath, "r") as f:
+        while True:
+            chunk = f.read(4096)
+            if chunk == "":
+                return False
+            chunk = chunk.lstrip()
+            if chunk != "":
+                return chunk[0] != "["
+
+# One cmd of lookahead over the cmds of a script, idx is the index of the
+# next cmd in the script. An invalid JSON Lines line ends the cmds, err
+# tells why.
+class CmdCursor(object):
+    def __init__(self, cmds):
+        self.cmds = cmds
+        self.head = None
+        self.idx = 0
+        self.err = None
+        self.fetch()
+
+    def fetch(self):
+        try:
+            self.head = next(self.cmds)
+        except StopIteration:
+            self.head = None
+        except Exception as e:
+            self.head = None
+            self.err = str(e)
+
+    def peek(self):
+        return self.head
+
+    def pop(self):
+        cmd = self.head
+        self.idx += 1
+        self.fetch()
+        return cmd
+
+# A script is a JSON array of cmds, or JSON Lines with one cmd per line
+# and an optional {"total_cmd": N} header as the first line. JSON Lines
+# scripts are read as they run, a cmd is only built and validated once
+# execution reaches it, an invalid line fails the run there; run
+# uts_validate.py to check a whole script up front.
 class UtScript(object):
-    def __init__(self, json_script_fpath):
+    TOTAL_CMD = "total_cmd"
+    REPORT_MAX_CMDS = 1000
+
+    def __init__(self, json_script_fpath, use_cache=None):
+        self.fpath = json_script_fpath
+        self.from_cache = False
+        self.cmd_list = None
+        self.total = None
+        # opened by the first cacheable cmd
+        self.result_cache = None
+        self.result_cache_lock = threading.Lock()
+        self.json_lines = is_json_lines(json_script_fpath)
+        if self.json_lines:
+            return
         with open(json_script_fpath, "r") as f:
             json_script_str = f.read().rstrip()
-        script_data = json.loads(json_script_str)
-        self.cmd_list = []
-        for cmd_data in script_data:
-            self.cmd_list.append(UtCmd(cmd_data))
+        if use_cache is None:
+            use_cache = _UT_CONFIG_.script_cache
+        cache = None
+        if use_cache:
+            cache = UtScriptCache(script_version())
+            script_data = cache.load(json_script_str)
+            if script_data is not None:
+                with gc_paused():
+                    self.cmd_list = [UtCmd(x, True) for x in script_data]
+                self.from_cache = True
+                return
+        with gc_paused():
+            script_data = json.loads(json_script_str)
+            self.cmd_list = []
+            for cmd_data in script_data:
+                self.cmd_list.append(UtCmd(cmd_data))
+        self.validate_cmd_deps()
+        if cache is not None:
+            cache.save(json_script_str, script_data)
+
+    # a cmd may only wait for cmds before it, so the script order is
+    # always a valid run order
+    def validate_cmd_deps(self):
+        cmd_ids = set()
+        for cmd in self.cmd_list:
+            self.check_cmd_deps(cmd, cmd_ids)
+
+    def check_cmd_deps(self, cmd, cmd_ids):
+        for cmd_id in cmd.after:
+            if cmd_id not in cmd_ids:
+                err = "CMD after refers to unknown or later cmd {0}:\n"\
+                      "{1}".format(cmd_id, cmd.cmdline)
+                raise Exception(err)
+        if cmd.cmd_id is None:
+            return
+        if cmd.cmd_id in cmd_ids:
+            err = "CMD id {0} is not unique".format(cmd.cmd_id)
+            raise Exception(err)
+        cmd_ids.add(cmd.cmd_id)
+
+    def is_header(self, line_no, cmd_data):
+        return line_no == 1 and isinstance(cmd_data, dict) and \
+               self.TOTAL_CMD in cmd_data and UtCmd.CMDLINE not in cmd_data
+
+    # (line number, cmd data) of each non blank line
+    def iter_json_lines_data(self):
+        with open(self.fpath, "r") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if line == "":
+                    continue
+                try:
+                    cmd_data = json.loads(line)
+                except Exception as e:
+                    err = "Fail to read in script {0} line {1}, {2}".format(\
+                          self.fpath, line_no, str(e))
+                    raise Exception(err)
+                yield line_no, cmd_data
+
+    def iter_json_lines(self):
+        cmd_ids = set()
+        for line_no, cmd_data in self.iter_json_lines_data():
+            if self.is_header(line_no, cmd_data):
+                continue
+            try:
+                cmd = UtCmd(cmd_data)
+                self.check_cmd_deps(cmd, cmd_ids)
+            except Exception as e:
+                err = "Script {0} line {1}:\n{2}".format(self.fpath, line_no,
+                                                        str(e))
+                raise Exception(err)
+            yield cmd
+
+    def iter_cmds(self):
+        if self.json_lines:
+            return self.iter_json_lines()
+        return iter(self.cmd_list)
 
     def total_cmd(self):
+        if self.json_lines:
+            if self.total is None:
+                self.total = self.scan_total()
+            return self.total
         count = 0
         for cmd in self.cmd_list:
             count += cmd.exec_cnt
         return count
 
-    def run_one_cmd(self, cmd, ssh, log, result):
-        rc = UtCmd.RC_OK
-        for i in xrange(cmd.exec_cnt):
-            logger.info("CMD: exec round #{0}".format(i))
+    # From the header, or else a pass over the lines, only lines
+    # mentioning exec_cnt are decoded
+    def scan_total(self):
+        total = 0
+        with open(self.fpath, "r") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if line == "":
+                    continue
+                if line_no == 1 and self.TOTAL_CMD in line:
+                    cmd_data = json.loads(line)
+                    if self.is_header(line_no, cmd_data):
+                        total = cmd_data[self.TOTAL_CMD]
+                        if not isinstance(total, int) or total < 0:
+                            err = "Script {0} header total_cmd should be "\
+                                  "an int:\n{1}".format(self.fpath, line)
+                            raise Exception(err)
+                        return total
+                if UtCmd.EXEC_CNT not in line:
+                    total += 1
+                    continue
+                try:
+                    exec_cnt = json.loads(line).get(UtCmd.EXEC_CNT, 1)
+                except Exception:
+                    exec_cnt = 1
+                if isinstance(exec_cnt, int) and exec_cnt > 0:
+                    total += exec_cnt
+                else:
+                    total += 1
+        return total
+
+    def run_one_cmd(self, cmd, ssh, log, result, first_round=0,
+                    on_round=None):
+        rc, out, err = self.exec_rounds(cmd, ssh, log, result, first_round,
+                                        on_round)
+        if rc != UtCmd.RC_OK:
+            self.save_last_fail_cmd(cmd, out, err)
+        return rc
+
+    # on_round is called with the count of rounds done after each
+    # successful round
+    def exec_rounds(self, cmd, ssh, log, result, first_round=0,
+                    on_round=None):
+        rc, out, err = UtCmd.RC_OK, "", ""
+        for i in xrange(first_round, cmd.exec_cnt):
+            logger.info("CMD: exec round #%d", i)
             for j in xrange(cmd.retry+1):
-                logger.info("CMD: try round #{0}".format(j))
-                log.add_action_entry(cmd.cmdline)
-                rc, out, err = cmd.execute(ssh)
-                log.add_result_entry(rc, out, err)
+                logger.info("CMD: try round #%d", j)
+                timing = CmdTiming(cmd.cmdline)
+                timing.attempt = j + 1
+                with timing.phase(CmdTiming.LOG):
+                    log.add_action_entry(cmd.cmdline)
+                # a retry runs the cmd again, the cached output failed
+                cached, age = None, None
+                if j == 0:
+                    cached = self.get_cached(cmd, ssh, result)
+                if cached is not None:
+                    out, age = cached
+                    rc, out, err = cmd.check_result(True, out, "", timing)
+                else:
+                    rc, out, err = cmd.execute(ssh, timing)
+                    self.put_cached(cmd, ssh, rc, out)
+                timing.rc = rc
+                with timing.phase(CmdTiming.LOG):
+                    log.add_result_entry(rc, out, err, age)
+                # a hit is no execution, keep it out of timings and history
+                if cached is None:
+                    result.add_timing(timing)
                 if rc == UtCmd.RC_OK:
                     result.inc_success()
                     break
-        if rc != UtCmd.RC_OK:
+            if on_round is not None and rc == UtCmd.RC_OK:
+                on_round(i + 1)
+        return rc, out, err
+
+    def get_result_cache(self):
+        with self.result_cache_lock:
+            if self.result_cache is None:
+                self.result_cache = UtResultCache()
+        return self.result_cache
+
+    def close_result_cache(self):
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
+
+    # (out, age) of a cacheable cmd on the same host, None is a miss. A
+    # broken cache is a miss, it must not fail the session.
+    def get_cached(self, cmd, ssh, result):
+        if cmd.cache_ttl is None or not _UT_CONFIG_.result_cache:
+            return None
+        try:
+            cached = self.get_result_cache().get(ssh.ssh_detail(),
+                                                 cmd.cmdline, cmd.cache_ttl)
+        except Exception as e:
+            logger.warning("Result cache: fail to get '%s', %s",
+                           cmd.cmdline, e)
+            cached = None
+        logger.info("CMD: Result cache %s for '%s'",
+                    "hit" if cached is not None else "miss", cmd.cmdline)
+        result.add_cache(cmd.cmdline, cached is not None)
+        return cached
+
+    # the output is kept even if the regex group failed on it, the cmd
+    # wrote nothing to stderr then
+    def put_cached(self, cmd, ssh, rc, out):
+        if cmd.cache_ttl is None or not _UT_CONFIG_.result_cache or \
+           rc not in [UtCmd.RC_OK, UtCmd.RC_REGEX_FAIL]:
+            return
+        try:
+            self.get_result_cache().put(ssh.ssh_detail(), cmd.cmdline, out)
+        except Exception as e:
+            logger.warning("Result cache: fail to put '%s', %s",
+                           cmd.cmdline, e)
+
+    # next cmds to run together, a parallel group, a pipelined batch or
+    # one single cmd
+    def get_stage(self, cursor, ssh):
+        stage = [cursor.pop()]
+        if stage[0].parallel is not None:
+            while cursor.peek() is not None and \
+                  cursor.peek().parallel == stage[0].parallel:
+                stage.append(cursor.pop())
+            return stage
+        return self.get_batch(stage, cursor, ssh)
+
+    def get_batch(self, batch, cursor, ssh):
+        if not ssh.pipeline or not batch[0].is_batchable():
+            return batch
+        while len(batch) < _UT_CONFIG_.pipeline_max_cmds and \
+              cursor.peek() is not None and cursor.peek().is_batchable():
+            batch.append(cursor.pop())
+        return batch
+
+    def run_batch(self, batch, ssh, log, result):
+        logger.info("CMD: Execute %d cmds in one batch", len(batch))
+        batch_timing = CmdTiming()
+        exec_results = ssh.exec_batch([cmd.cmdline for cmd in batch],
+                                      batch_timing)
+        for i, cmd in enumerate(batch):
+            # the remote call is shared evenly by the cmds of the batch
+            timing = batch_timing.split(cmd.cmdline, len(batch))
+            with timing.phase(CmdTiming.LOG):
+                log.add_action_entry(cmd.cmdline)
+            if i < len(exec_results):
+                rc, out, err = cmd.check_result(*exec_results[i],
+                                                timing=timing)
+            else:
+                rc, out = UtCmd.RC_CMD_FAIL, ""
+                err = "Batch ended before cmd {0}".format(cmd.cmdline)
+            timing.rc = rc
+            with timing.phase(CmdTiming.LOG):
+                log.add_result_entry(rc, out, err)
+            result.add_timing(timing)
+            if rc != UtCmd.RC_OK:
+                self.save_last_fail_cmd(cmd, out, err)
+                return rc, cmd
+            result.inc_success()
+        return UtCmd.RC_OK, batch[-1]
+
+    # Cmds of a parallel group run on their own channels, a cmd starts
+    # once the cmds it runs after succeeded. After the first failure no
+    # new cmd is started. Log entries are replayed in script order and the
+    # first failed cmd in script order is reported.
+    def run_parallel(self, group, ssh, log, result):
+        logger.info("CMD: Execute %d cmds in parallel group %s",
+                    len(group), group[0].parallel)
+        lock = threading.Lock()
+        recorders = [CmdRecorder(result, lock) for cmd in group]
+        done = [threading.Event() for cmd in group]
+        cmd_idx = {}
+        for i, cmd in enumerate(group):
+            if cmd.cmd_id is not None:
+                cmd_idx[cmd.cmd_id] = i
+        failed = threading.Event()
+
+        def run_cmd(i):
+            cmd, recorder = group[i], recorders[i]
+            try:
+                for cmd_id in cmd.after:
+                    if cmd_id not in cmd_idx:
+                        continue
+                    done[cmd_idx[cmd_id]].wait()
+                    if recorders[cmd_idx[cmd_id]].rc != UtCmd.RC_OK:
+                        return
+                if failed.is_set():
+                    return
+                recorder.rc, recorder.out, recorder.err = \
+                    self.exec_rounds(cmd, ssh, recorder, recorder)
+                if recorder.rc != UtCmd.RC_OK:
+                    failed.set()
+            finally:
+                done[i].set()
+
+        # cmds only wait for earlier ones, so FIFO workers never deadlock
+        workers = min(len(group), _UT_CONFIG_.parallel_max_channels)
+        pool = ThreadPool(workers)
+        try:
+            pool.map(run_cmd, range(len(group)))
+        finally:
+            pool.close()
+            pool.join()
+
+        for recorder in recorders:
+            recorder.replay(log, result)
+        for cmd, recorder in zip(group, recorders):
+            if recorder.rc is not None and recorder.rc != UtCmd.RC_OK:
+                self.save_last_fail_cmd(cmd, recorder.out, recorder.err)
+                return recorder.rc, cmd
+        return UtCmd.RC_OK, group[-1]
+
+    # the session connection, unless its session shell would run the
+    # iterations one at a time, and new connections up to cnt
+    def open_transports(self, ssh, cnt):
+        backends = []
+        if getattr(ssh, "shell", None) is None:
+            backends.append(ssh)
+        try:
+            while len(backends) < cnt:
+                backends.append(ssh.open_transport())
+        except Exception:
+            self.close_transports(ssh, backends)
+            raise
+        return backends
+
+    def close_transports(self, ssh, backends):
+        for backend in backends:
+            if backend is not ssh:
+                backend.close()
+
+    # Iterations of a load cmd are issued by load.concurrency workers,
+    # iteration i not before i/rate seconds when rate is set. Latencies
+    # go to the load stats of the result rather than to the timings, and
+    # only the first load_log_samples successes and failures are logged.
+    # All iterations run, the first failed one is reported.
+    def run_load(self, cmd, ssh, log, result):
+        load = cmd.load
+        logger.info("CMD: Load %d iterations of '%s', %d concurrent",
+                    cmd.exec_cnt, cmd.cmdline, load.concurrency)
+        try:
+            backends = self.open_transports(ssh, load.transports)
+        except Exception as e:
+            rc, out, err = UtCmd.RC_CMD_FAIL, "", str(e)
+            log.add_action_entry(cmd.cmdline)
+            log.add_result_entry(rc, out, err)
             self.save_last_fail_cmd(cmd, out, err)
-        return rc
+            return rc
+        stats = LoadStats(cmd.cmdline, load.concurrency, load.rate,
+                          len(set([id(x) for x in backends])))
+        lock = threading.Lock()
+        next_idx = [0]
+        samples = []
+        sampled = {True:0, False:0}
+        first_fail = []
+        start = monotonic()
+
+        def run_iterations(k):
+            backend = backends[k % len(backends)]
+            while True:
+                with lock:
+                    i = next_idx[0]
+                    next_idx[0] += 1
+                if i >= cmd.exec_cnt:
+                    return
+                begin = monotonic()
+                if load.rate is not None:
+                    begin = start + i / float(load.rate)
+                    time.sleep(max(begin - monotonic(), 0))
+                rc, out, err = cmd.execute(backend)
+                latency = monotonic() - begin
+                ok = rc == UtCmd.RC_OK
+                with lock:
+                    stats.histogram.record(latency)
+                    stats.iterations += 1
+                    if ok:
+                        stats.success += 1
+                    elif len(first_fail) == 0:
+                        first_fail.append((rc, out, err))
+                    if sampled[ok] < _UT_CONFIG_.load_log_samples:
+                        sampled[ok] += 1
+                        samples.append((i, rc, out, err))
+
+        pool = ThreadPool(load.concurrency)
+        try:
+            pool.map(run_iterations, range(load.concurrency))
+        finally:
+            pool.close()
+            pool.join()
+            self.close_transports(ssh, backends)
+        stats.duration = monotonic() - start
+        stats.logged = len(samples)
+        logger.info("CMD: Load of '%s' done, %d/%d succeeded in %.3fs",
+                    cmd.cmdline, stats.success, stats.iterations,
+                    stats.duration)
+
+        for i, rc, out, err in sorted(samples):
+            log.add_action_entry(cmd.cmdline)
+            log.add_result_entry(rc, out, err)
+        for i in xrange(stats.success):
+            result.inc_success()
+        result.add_load(stats)
+        if len(first_fail) > 0:
+            rc, out, err = first_fail[0]
+            self.save_last_fail_cmd(cmd, out, err)
+            return rc
+        return UtCmd.RC_OK
 
     def save_last_fail_cmd(self, cmd, out, err):
         self.fail_cmdline = cmd.cmdline
         self.fail_out = out
         self.fail_err = err
 
+    # Skip the cmds done by former attempts and run their setup cmds
+    # again, e.g. a cd, the new connection has none of their effects.
+    # Setup cmds are not counted again in the result.
+    def skip_done_cmds(self, cursor, cmd_idx, ssh, log):
+        setup = []
+        while cursor.idx < cmd_idx and cursor.peek() is not None:
+            cmd = cursor.pop()
+            if cmd.setup:
+                setup.append(cmd)
+        logger.info("CMD: Resume from cmd #%d, replay %d setup cmds",
+                    cmd_idx, len(setup))
+        for cmd in setup:
+            rc = self.run_one_cmd(cmd, ssh, log, CmdRecorder())
+            if rc != UtCmd.RC_OK:
+                return rc, cmd
+        return UtCmd.RC_OK, None
+
+    # Progress is saved to the session checkpoint after each round of a
+    # single cmd and after each stage. A failed stage is saved as not
+    # started, a resume runs it again, a batch from the failed cmd on and
+    # a resumed cmd from its resumed round on.
     def run(self, session):
         ssh = session.ssh
         log = session.log
         result = session.result
-        for cmd in self.cmd_list:
-            rc = self.run_one_cmd(cmd, ssh, log, result)
+        checkpoint = session.checkpoint
+        rc = UtCmd.RC_OK
+        first_round = 0
+        cursor = CmdCursor(self.iter_cmds())
+        if checkpoint is not None and checkpoint.is_resumed():
+            rc, cmd = self.skip_done_cmds(cursor, checkpoint.cmd_idx, ssh, log)
+            if rc != UtCmd.RC_OK:
+                logger.info("Fail on setup CMD %s, exit", cmd.cmdline)
+                self.rc = rc
+                return rc
+            first_round = checkpoint.exec_round
+        while cursor.peek() is not None:
+            start_idx = cursor.idx
+            start_success = result.success
+            # rounds of a resumed cmd done before, already in success
+            start_round, first_round = first_round, 0
+            fail_round = 0
+            stage = self.get_stage(cursor, ssh)
+            if stage[0].parallel is not None:
+                rc, cmd = self.run_parallel(stage, ssh, log, result)
+                done = 0
+            elif len(stage) > 1:
+                rc, cmd = self.run_batch(stage, ssh, log, result)
+                done = stage.index(cmd)
+            else:
+                cmd = stage[0]
+                on_round = None
+                if checkpoint is not None:
+                    on_round = lambda n: checkpoint.update(start_idx, n,
+                                                           result.success)
+                if cmd.load is not None:
+                    rc = self.run_load(cmd, ssh, log, result)
+                else:
+                    rc = self.run_one_cmd(cmd, ssh, log, result,
+                                          start_round, on_round)
+                    fail_round = start_round
+                done = 0
             if rc != UtCmd.RC_OK:
-                logger.info("Fail on CMD {0}, exit".format(cmd.cmdline))
+                logger.info("Fail on CMD %s, exit", cmd.cmdline)
+                if checkpoint is not None:
+                    checkpoint.update(start_idx + done, fail_round,
+                                      start_success + done, force=True)
                 break
+            if checkpoint is not None:
+                checkpoint.update(cursor.idx, 0, result.success)
+        if rc == UtCmd.RC_OK and cursor.err is not None:
+            rc = self.fail_script_line(cursor.err, log)
+            if checkpoint is not None:
+                checkpoint.update(cursor.idx, 0, result.success, force=True)
         self.rc = rc
         return rc
 
+    # the cmds before an invalid line ran, the line fails like a cmd
+    def fail_script_line(self, err, log):
+        logger.info("Invalid script line, exit\n%s", err)
+        log.add_action_entry(self.fpath)
+        log.add_result_entry(UtCmd.RC_CMD_FAIL, "", err)
+        self.fail_cmdline = self.fpath
+        self.fail_out = ""
+        self.fail_err = err
+        return UtCmd.RC_CMD_FAIL
+
     def generate_report(self):
         s = ""
         if self.rc == UtCmd.RC_CMD_FAIL:
             s += "Failed to run command:\n"
         elif self.rc == UtCmd.RC_REGEX_FAIL:
             s += "Failed to evaluate REGEX for command:\n"
+        elif self.rc == UtCmd.RC_TIMEOUT:
+            s += "Timed out running command:\n"
         if self.rc != UtCmd.RC_OK:
             s += (self.fail_cmdline + "\n")
             s += "Command output:\n"
@@ -321,8 +1308,28 @@ class UtScript(object):
         return s
 
     def dump_all_cmd(self):
-        s = "Whole command list:\n"
-        for cmd in self.cmd_list:
-            s += "{0} {1}\n".format(cmd.exec_cnt, cmd.cmdline)
-        return s
+        lines = ["Whole command list:\n"]
+        if not self.json_lines:
+            for cmd in self.cmd_list:
+                lines.append("{0} {1}\n".format(cmd.exec_cnt, cmd.cmdline))
+            return "".join(lines)
+        # only the first cmds of a JSON Lines script
+        count = 0
+        try:
+            for line_no, cmd_data in self.iter_json_lines_data():
+                if self.is_header(line_no, cmd_data):
+                    continue
+                count += 1
+                if count <= self.REPORT_MAX_CMDS:
+                    lines.append("{0} {1}\n".format(\
+                                 cmd_data.get(UtCmd.EXEC_CNT, 1),
+                                 cmd_data.get(UtCmd.CMDLINE, "")))
+        except Exception as e:
+            # the invalid line is reported above
+            lines.append("... unreadable from here, {0}\n".format(e))
+            return "".join(lines)
+        if count > self.REPORT_MAX_CMDS:
+            lines.append("... {0} more cmds\n".format(\
+                         count - self.REPORT_MAX_CMDS))
+        return "".join(lines)
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import gc
+import marshal
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from UtLogger import logger
+from UtConfig import _UT_CONFIG_
+
+# Validated script data, the plain cmd dicts, marshalled under
+# <root_path>/<script_cache_dir>/ and keyed by the sha1 of the script
+# content and of the harness version, so a changed script or harness
+# never loads a stale entry. A hit skips validation and pattern
+# compiling, patterns are compiled on first use. Least recently used
+# entries are removed once the dir takes more than script_cache_max_bytes.
+class UtScriptCache(object):
+    SUFFIX = ".marshal"
+
+    def __init__(self, version, path=None):
+        if path is None:
+            path = os.path.join(_UT_CONFIG_.root_path,
+                                _UT_CONFIG_.script_cache_dir)
+        self.version = version
+        self.path = path
+
+    def fpath(self, script_str):
+        digest = hashlib.sha1(self.version)
+        digest.update(script_str)
+        return os.path.join(self.path, digest.hexdigest() + self.SUFFIX)
+
+    # a missing or unreadable entry is a miss
+    def load(self, script_str):
+        fpath = self.fpath(script_str)
+        if not os.path.exists(fpath):
+            return None
+        try:
+            with open(fpath, "rb") as f:
+                script_data = marshal.loads(f.read())
+            # the mtime tells the least recently used entries
+            os.utime(fpath, None)
+            return script_data
+        except Exception as e:
+            logger.warning("Script cache: fail to load %s, %s", fpath, e)
+            return None
+
+    # written to a temp file and renamed, concurrent jobs may save the
+    # same script
+    def save(self, script_str, script_data):
+        fpath = self.fpath(script_str)
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            fd, tmp_fpath = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(script_data, f)
+            os.rename(tmp_fpath, fpath)
+            self.evict()
+        except Exception as e:
+            logger.warning("Script cache: fail to save %s, %s", fpath, e)
+
+    def evict(self):
+        entries, total = [], 0
+        for fname in os.listdir(self.path):
+            if not fname.endswith(self.SUFFIX):
+                continue
+            fpath = os.path.join(self.path, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fpath))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, fpath in entries:
+            if total <= _UT_CONFIG_.script_cache_max_bytes:
+                break
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+            total -= size
+
+# the collector would rescan the objects created so far over and over
+# while a large script is built, it costs more than the build itself
+@contextmanager
+def gc_paused():
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
@@ -2,29 +2,57 @@
 # encoding: utf-8
 
 import os
+import json
 import datetime
 from UtLog import UtLog
+from UtIndex import UtIndex
+from UtHistory import UtHistory, format_regressions
 from UtSSH import UtSSH
-from UtScript import UtScript
+from UtLocal import UtLocal, is_local
+from UtScript import UtScript, UtCmd
 from UtResult import UtResult
 from UtNotify import UtNotify
+from UtCheckpoint import UtCheckpoint
+from UtLogger import logger
 from UtConfig import _UT_CONFIG_
 
+# the cmds run over SSH, or on this host with "backend": "local" in the
+# SSH config; ssh_config is the json config file path or the loaded dict
+def new_backend(ssh_config, ssh_pool=None):
+    config = ssh_config
+    if not isinstance(config, dict):
+        with open(config, "r") as f:
+            config = json.loads(f.read())
+    if is_local(config):
+        return UtLocal(config)
+    return UtSSH(ssh_config, ssh_pool)
+
 class UtSession(object):
-    def __init__(self, ssh_config_fpath, script_fpath, notify_fpath):
-        self.ses_id = self.init_ses_id()
+    # ses_tag tells apart sessions started by one process at the same time,
+    # resume_from is the path of a former session of the same script to
+    # go on from its checkpoint
+    def __init__(self, ssh_config, script_fpath, notify_fpath,
+                 ssh_pool=None, ses_tag=None, resume_from=None):
+        self.ses_id = self.init_ses_id(ses_tag)
         self.ses_path = self.init_ses_path()
-        self.ssh = UtSSH(ssh_config_fpath)
+        self.ssh = new_backend(ssh_config, ssh_pool)
         self.script = UtScript(script_fpath)
         self.notify = UtNotify(notify_fpath)
         self.log = UtLog(self)
         self.result = UtResult()
+        self.resume_from = resume_from
+        self.checkpoint = None
+        if _UT_CONFIG_.checkpoint or resume_from is not None:
+            self.checkpoint = UtCheckpoint(self.ses_id, self.ses_path,
+                                           script_fpath)
 
-    def init_ses_id(self):
+    def init_ses_id(self, ses_tag):
         ts_fmt = "%Y%m%d%H%M%S"
         ts = datetime.datetime.now().strftime(ts_fmt)
         pid = os.getpid()
         ses_id = "SES{0}_{1}".format(ts, pid)
+        if ses_tag is not None:
+            ses_id += "_{0}".format(ses_tag)
         return ses_id
 
     def init_ses_path(self):
@@ -37,18 +65,72 @@ class UtSession(object):
     def prepare(self):
         self.log.init_log_file()
         self.result.set_total(self.script.total_cmd())
+        if self.checkpoint is not None:
+            if self.resume_from is not None:
+                self.checkpoint.resume(self.resume_from)
+                self.result.success = self.checkpoint.success
+            self.checkpoint.start_attempt()
 
     def go(self):
-        self.ssh.connect()
-        self.result.record_start_ts()
-        rc = self.script.run(self)
-        self.result.record_end_ts()
-        self.result.set_result(rc)
-        self.result.set_run_report(self.script.generate_report())
-        self.ssh.close()
+        try:
+            self.ssh.connect()
+            self.result.record_start_ts()
+            rc = self.script.run(self)
+            self.result.record_end_ts()
+            self.result.set_result(rc)
+            report = self.script.generate_report()
+            if self.checkpoint is not None:
+                fail_cmdline = None
+                if rc != UtCmd.RC_OK:
+                    fail_cmdline = self.script.fail_cmdline
+                self.checkpoint.finish_attempt(rc, fail_cmdline)
+                report += self.checkpoint.format_attempts()
+            if _UT_CONFIG_.history:
+                report += self.add_to_history()
+            self.result.set_run_report(report)
+            self.result.export_metrics(self.ses_id, self.ssh.ssh_detail(),
+                                       self.ses_path)
+        finally:
+            # progress since the last periodic save
+            if self.checkpoint is not None:
+                self.checkpoint.save()
+            self.ssh.close()
+            self.script.close_result_cache()
+            self.log.close()
+            self.add_to_index()
 
-    def send_notify(self):
+    # a broken index must not fail the session, uts_query.py --reindex
+    # picks up sessions missing from it
+    def add_to_index(self):
+        try:
+            UtIndex().add_session(self)
+        except Exception as e:
+            logger.warning("Fail to index %s, %s", self.ses_id, e)
+
+    # Returns the report section of the cmds slower than in the sessions
+    # before. A broken history must not fail the session either.
+    def add_to_history(self):
+        history = UtHistory()
+        try:
+            history.add_session(self)
+            regressions = history.session_regressions(self)
+        except Exception as e:
+            logger.warning("Fail to add %s to history, %s", self.ses_id, e)
+            return ""
+        finally:
+            history.close()
+        if len(regressions) == 0:
+            return ""
+        return "\nSlower than the last {0} days:\n{1}".format(\
+               _UT_CONFIG_.history_baseline_days,
+               format_regressions(regressions))
+
+    def notify_mail(self):
         subject = "UTS#{0}, {1}".format(self.ses_id, self.result.summary())
-        msg_body = self.result.detail()
-        self.notify.sendmail(subject, msg_body)
+        return subject, self.result.detail()
+
+    # queued, see UtNotifyQueue
+    def send_notify(self):
+        subject, msg_body = self.notify_mail()
+        self.notify.post(subject, msg_body, self.result.result == True)
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import re
+import uuid
+import select
+import threading
+from UtLogger import logger
+from UtUtil import shell_quote, kill_remote, CmdTimeout
+from UtUtil import CHANNEL_POLL_INTERVAL
+from UtTiming import CmdTiming, monotonic
+
+# One long-lived shell channel per session. Every command is framed by a
+# unique end mark on both stdout and stderr, the mark on stdout carries
+# the exit status. The shell state, e.g. cwd, carries over between cmds.
+# Cmds from several threads are run one after another. A cmd run past its
+# deadline is killed together with the shell, the next cmd starts a new
+# shell.
+class UtShell(object):
+    END_MARK = "UTS_END_"
+    PID_MARK = "UTS_PID_"
+    READ_SIZE = 32 * 1024
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.channel = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        logger.info("SHELL: open session shell")
+        self.channel = self.transport.open_session()
+        self.channel.invoke_shell()
+        # the profile or motd may print before the first cmd, the echoed
+        # cmdline holds no digits after the mark
+        status, out, err = self.exec_cmd_locked(
+            "echo {0}$$".format(self.PID_MARK), CmdTiming())
+        pids = re.findall(r"{0}(\d+)".format(self.PID_MARK), out)
+        if not pids:
+            raise Exception("no shell pid in {0!r}".format(out[-200:]))
+        self.pid = int(pids[-1])
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+        self.pid = None
+
+    def is_alive(self):
+        return self.channel is not None and not self.channel.closed and \
+               not self.channel.exit_status_ready()
+
+    def frame_cmd(self, cmdline, mark):
+        s = "eval {0} </dev/null\n".format(shell_quote(cmdline))
+        s += "printf '\\n%s %d\\n' {0} $?\n".format(mark)
+        s += "printf '\\n%s\\n' {0} >&2\n".format(mark)
+        return s
+
+    # returns exit status, out and err of the cmd, raises CmdTimeout once
+    # the monotonic deadline is passed
+    def exec_cmd(self, cmdline, timing=None, deadline=None):
+        if timing is None:
+            timing = CmdTiming(cmdline)
+        with self.lock:
+            return self.exec_cmd_locked(cmdline, timing, deadline)
+
+    def exec_cmd_locked(self, cmdline, timing, deadline=None):
+        if not self.is_alive():
+            with timing.phase(CmdTiming.OPEN):
+                self.close()
+                self.open()
+        mark = self.END_MARK + uuid.uuid4().hex
+        start = monotonic()
+        first_ts = None
+        self.channel.sendall(self.frame_cmd(cmdline, mark))
+
+        out, err = "", ""
+        out_end, err_end = -1, -1
+        status = None
+        channel = self.channel
+        # only rescan the part that may hold a new end mark
+        margin = len(mark) + 16
+        while out_end < 0 or err_end < 0:
+            has_data = False
+            out_pos, err_pos = len(out), len(err)
+            if channel.recv_ready():
+                out += channel.recv(self.READ_SIZE)
+                has_data = True
+            if channel.recv_stderr_ready():
+                err += channel.recv_stderr(self.READ_SIZE)
+                has_data = True
+            if out_end < 0:
+                pos = max(0, out_pos - margin)
+                out_end, status = self.find_out_mark(out, mark, pos)
+            if err_end < 0:
+                pos = max(0, err_pos - margin)
+                err_end = err.find("\n{0}\n".format(mark), pos)
+            if has_data:
+                if first_ts is None:
+                    first_ts = monotonic()
+                continue
+            if channel.closed or channel.exit_status_ready():
+                err = "Session shell exited while running '{0}'".format(\
+                      cmdline)
+                raise Exception(err)
+            wait = CHANNEL_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    self.kill()
+                    timing.add_exec_read(start, first_ts)
+                    raise CmdTimeout(cmdline, out, err)
+            # stdout data wakes up select, stderr is polled
+            select.select([channel], [], [], wait)
+        timing.add_exec_read(start, first_ts)
+        return status, out[:out_end], err[:err_end]
+
+    def kill(self):
+        if self.pid is not None:
+            kill_remote(self.transport, self.pid)
+            self.pid = None
+        self.close()
+
+    def find_out_mark(self, out, mark, pos):
+        start = out.find("\n{0} ".format(mark), pos)
+        if start < 0:
+            return -1, None
+        end = out.find("\n", start + 1)
+        if end < 0:
+            return -1, None
+        status = out[start+1:end].split(" ")[1]
+        return start, int(status)
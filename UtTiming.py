@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+import math
+import time
+import random
+from contextlib import contextmanager
+
+# time.time follows wall clock adjustments, use CLOCK_MONOTONIC where
+# python 2 does not expose it
+def init_monotonic():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        if sys.platform == "darwin":
+            clock_id = 6
+        else:
+            clock_id = 1
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                err = "clock_gettime failed, errno {0}".format(\
+                      ctypes.get_errno())
+                raise Exception(err)
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = init_monotonic()
+
+def percentile(sorted_samples, p):
+    idx = int(round(p / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[idx]
+
+# Seconds spent in each phase of one cmd execution:
+# open  - channel open and exec request, or reopening the session shell
+# exec  - remote execution until the first output arrives
+# read  - reading the rest of the output
+# regex - regex group evaluation
+# log   - writing the log entries
+# attempt is the try of the exec round, from 1, and rc the UtCmd rc
+class CmdTiming(object):
+    __slots__ = ("cmdline", "phases", "attempt", "rc")
+    OPEN = "open"
+    EXEC = "exec"
+    READ = "read"
+    REGEX = "regex"
+    LOG = "log"
+    PHASES = [OPEN, EXEC, READ, REGEX, LOG]
+
+    def __init__(self, cmdline=""):
+        self.cmdline = cmdline
+        self.phases = dict([(x, 0.0) for x in self.PHASES])
+        self.attempt = 1
+        self.rc = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    @contextmanager
+    def phase(self, phase):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases[phase] += monotonic() - start
+
+    # exec until the first output at first_ts, or until now without any
+    # output, read from then on
+    def add_exec_read(self, start, first_ts):
+        end_ts = monotonic()
+        if first_ts is None:
+            first_ts = end_ts
+        self.phases[self.EXEC] += first_ts - start
+        self.phases[self.READ] += end_ts - first_ts
+
+    # the share of one of cnt cmds run in one remote call
+    def split(self, cmdline, cnt):
+        timing = CmdTiming(cmdline)
+        for phase in self.PHASES:
+            timing.phases[phase] = self.phases[phase] / cnt
+        return timing
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def format_phases(self):
+        return " ".join(["{0} {1:.3f}".format(x, self.phases[x]) \
+                         for x in self.PHASES])
+
+# Latencies bucketed as in HdrHistogram: microseconds, each power of two
+# split in 2^SUB_BITS linear buckets, i.e. about 3% precision in a few
+# hundred buckets whatever the number of values
+class LatencyHistogram(object):
+    SUB_BITS = 5
+    PERCENTILES = [50, 75, 90, 95, 99, 99.9, 99.99, 100]
+
+    def __init__(self):
+        # (shift, value >> shift) -> count
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = max(int(seconds * 1e6), 0)
+        shift = max(us.bit_length() - self.SUB_BITS - 1, 0)
+        key = (shift, us >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        self.max = max(self.max, seconds)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.sum / self.count
+
+    # seconds, the highest value of the bucket holding the p percentile
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        target = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for shift, value in sorted(self.counts):
+            seen += self.counts[(shift, value)]
+            if seen >= target:
+                upper = (((value + 1) << shift) - 1) / 1e6
+                return min(upper, self.max)
+        return self.max
+
+    def format(self):
+        s = "{0:>10} {1:>12} {2:>10}\n".format("percentile", "latency(ms)",
+                                               "count")
+        for p in self.PERCENTILES:
+            s += "{0:>10} {1:>12.3f} {2:>10}\n".format(\
+                 "{0:g}".format(p), self.percentile(p) * 1000,
+                 int(math.ceil(p / 100.0 * self.count)))
+        return s
+
+# Executions of one cmdline in memory that does not grow with their
+# count: durations go to a histogram, and a uniform sample of at most
+# SAMPLE_MAX (attempt, rc, duration) is kept for the run history
+class CmdStats(object):
+    SAMPLE_MAX = 100
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.samples = []
+
+    def add(self, timing):
+        duration = timing.total()
+        self.histogram.record(duration)
+        sample = (timing.attempt, timing.rc, duration)
+        if len(self.samples) < self.SAMPLE_MAX:
+            self.samples.append(sample)
+            return
+        # reservoir sampling
+        idx = random.randrange(self.histogram.count)
+        if idx < self.SAMPLE_MAX:
+            self.samples[idx] = sample
+
+    def summary(self, percentiles):
+        h = self.histogram
+        x = {"count":h.count, "sum":h.sum}
+        for p in percentiles:
+            x["p{0}".format(p)] = h.percentile(p)
+        return x
+
+# Outcome of the iterations of a cmd in load mode, latency is taken from
+# the scheduled start with a target rate, so a slow server is not hidden
+# by iterations started late
+class LoadStats(object):
+    def __init__(self, cmdline, concurrency, rate, transports):
+        self.cmdline = cmdline
+        self.concurrency = concurrency
+        self.rate = rate
+        self.transports = transports
+        self.iterations = 0
+        self.success = 0
+        self.logged = 0
+        self.duration = 0.0
+        self.histogram = LatencyHistogram()
+
+    def throughput(self):
+        if self.duration <= 0:
+            return 0.0
+        return self.iterations / self.duration
+
+    def format(self):
+        s = "{0}\n".format(self.cmdline)
+        s += "  {0} iterations, {1} failed, {2} concurrent on {3} "\
+             "transports".format(self.iterations,
+                                 self.iterations - self.success,
+                                 self.concurrency, self.transports)
+        if self.rate is not None:
+            s += ", target {0:g}/s".format(self.rate)
+        s += "\n  {0:.3f}s, {1:.1f}/s, {2} outputs logged\n".format(\
+             self.duration, self.throughput(), self.logged)
+        h = self.histogram
+        s += "  latency(ms) min {0:.3f} mean {1:.3f} max {2:.3f}\n".format(\
+             (h.min or 0.0) * 1000, h.mean() * 1000, h.max * 1000)
+        s += "".join(["  " + x + "\n" for x in h.format().splitlines()])
+        return s
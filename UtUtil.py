@@ -1,28 +1,92 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import time
 import subprocess
+from collections import deque
 from UtLogger import logger
 
 def exec_cmd(cmd_line):
-    logger.debug("Running {0}".format(cmd_line))
-    out = ""
+    logger.debug("Running %s", cmd_line)
+    lines = []
     p = subprocess.Popen(cmd_line,
                          stdin=None,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.STDOUT)
-    while True:
-        line = p.stdout.readline()
-        if line != "":
-            logger.debug(line.strip())
-            out += line
-            continue
-        rc = p.poll()
-        if rc is not None:
-            break
+    # readline blocks until the next line or the end of the output
+    for line in iter(p.stdout.readline, ""):
+        logger.debug("%s", line.strip())
+        lines.append(line)
+    p.stdout.close()
+    rc = p.wait()
 
     if rc != 0:
-        logger.warning("Fail on {0}".format(cmd_line))
+        logger.warning("Fail on %s", cmd_line)
 
-    return rc, out
+    return rc, "".join(lines)
 
+
+def shell_quote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+# rc of a remote exec run past its deadline, next to True and False
+EXEC_TIMEOUT = "timeout"
+
+# select on a paramiko channel wakes up on stdout data and the eof only,
+# stderr is read once this is over
+CHANNEL_POLL_INTERVAL = 0.01
+
+# out and err are read before the deadline
+class CmdTimeout(Exception):
+    def __init__(self, cmdline, out="", err=""):
+        Exception.__init__(self, cmdline)
+        self.out = out
+        self.err = err
+
+# Stop a remote cmd by killing its process group, sshd makes every session
+# a process group of its own. Runs on a new channel of the transport,
+# SIGKILL follows if SIGTERM is not enough.
+def kill_remote(transport, pid, grace=5):
+    logger.info("Kill remote process group %d", pid)
+    s = "(kill -TERM -{0}; sleep {1}; kill -KILL -{0}) "\
+        ">/dev/null 2>&1 </dev/null &".format(pid, grace)
+    try:
+        channel = transport.open_session()
+        channel.exec_command(s)
+        # the shell returns once the kill is in the background
+        end = time.time() + grace
+        while not channel.exit_status_ready() and time.time() < end:
+            time.sleep(0.05)
+        channel.close()
+    except Exception as e:
+        logger.warning("Fail to kill remote process group %d, %s", pid, e)
+
+# Keep the first and last size bytes of a stream, drop the middle
+class OutputWindow(object):
+    def __init__(self, size):
+        self.size = size
+        self.head = ""
+        self.tail = deque()
+        self.tail_len = 0
+        self.total = 0
+
+    def append(self, data):
+        self.total += len(data)
+        if len(self.head) < self.size:
+            n = self.size - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        if data == "":
+            return
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail_len - len(self.tail[0]) >= self.size:
+            self.tail_len -= len(self.tail.popleft())
+
+    def text(self):
+        tail = "".join(self.tail)[-self.size:]
+        omitted = self.total - len(self.head) - len(tail)
+        if omitted <= 0:
+            return self.head + tail
+        return "{0}\n... {1} bytes omitted ...\n{2}".format(\
+               self.head, omitted, tail)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import errno
+import time
+import signal
+import threading
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+from UtLogger import logger
+from UtNotify import UtNotify
+from UtConfig import _UT_CONFIG_
+
+# Job descriptor, a json file named *.job dropped into the spool directory:
+# {"ssh_config":"ssh_config.json", "script":"script.json",
+#  "notify":"notify.json"}
+# Relative paths are relative to the spool directory.
+JOB_SSH_CONFIG = "ssh_config"
+JOB_SCRIPT = "script"
+JOB_NOTIFY = "notify"
+
+# per process, shared by all jobs run in one pool process
+_SSH_POOL_ = None
+# (job, pid) of each job as it starts, to tell which jobs a dead pool
+# process took with it. Not buffered by a feeder thread, the pid is sent
+# even if the process dies right after.
+_JOB_PIDS_ = None
+
+def init_job_process(job_pids):
+    global _SSH_POOL_, _JOB_PIDS_
+    _JOB_PIDS_ = job_pids
+    # the parent handles the shutdown, let in-flight jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from UtSSHPool import UtSSHPool
+    _SSH_POOL_ = UtSSHPool()
+    _SSH_POOL_.start_reaper()
+
+def load_job(job_fpath, spool_path):
+    with open(job_fpath, "r") as f:
+        job_str = f.read().rstrip()
+    job = json.loads(job_str)
+    result = ""
+    for name in [JOB_SSH_CONFIG, JOB_SCRIPT, JOB_NOTIFY]:
+        if name not in job:
+            result += "Missing {0},\n".format(name)
+    if result != "":
+        result += "Job:\n{0}".format(job_str)
+        err = "Fail to read in job:\n" + result
+        raise Exception(err)
+    paths = []
+    for name in [JOB_SSH_CONFIG, JOB_SCRIPT, JOB_NOTIFY]:
+        paths.append(os.path.join(spool_path, job[name]))
+    return paths
+
+# runs in a pool process, the mail is sent by the worker process so the
+# pool process is free for the next job and digests span all jobs. Any
+# error is part of the result, apply_async has no error callback and a
+# job raising here would never leave spool/running.
+def run_job(job_fpath, spool_path):
+    start = time.time()
+    job_result = {"job":os.path.basename(job_fpath), "ok":False}
+    _JOB_PIDS_.put((job_result["job"], os.getpid()))
+    try:
+        from UtFleet import UtFleet
+        from UtSession import UtSession
+        # jobs run back to back in one process, tell their sessions apart
+        ses_tag = os.path.splitext(job_result["job"])[0]
+        json_input = load_job(job_fpath, spool_path)
+        fleet = UtFleet(json_input[0], json_input[1], json_input[2],
+                        ssh_pool=_SSH_POOL_, ses_tag=ses_tag)
+        if len(fleet.host_configs) > 1:
+            fleet.go()
+            job_result["notify"] = [json_input[2]] + list(fleet.notify_mail())
+            job_result["ses_id"] = fleet.fleet_id
+            job_result["summary"] = fleet.summary()
+            job_result["ok"] = fleet.passed_cnt() == len(fleet.host_runs)
+        else:
+            session = UtSession(json_input[0], json_input[1], json_input[2],
+                                _SSH_POOL_, ses_tag)
+            session.prepare()
+            session.go()
+            job_result["notify"] = [json_input[2]] + \
+                                   list(session.notify_mail())
+            job_result["ses_id"] = session.ses_id
+            job_result["summary"] = session.result.summary()
+            job_result["ok"] = session.result.result == True
+    except Exception as e:
+        logger.error("Job %s failed, %s", job_fpath, e)
+        job_result["error"] = str(e)
+    job_result["run_time"] = time.time() - start
+    return job_result
+
+# Long running worker. Jobs are claimed by moving them from the spool
+# directory into spool/running, at most max_jobs at a time, and moved to
+# spool/done or spool/failed when finished. A job whose pool process
+# died, or killed past worker_job_timeout, is moved to spool/failed.
+# SIGINT/SIGTERM stop claiming new jobs, in-flight sessions are finished
+# before exit.
+class UtWorker(object):
+    RUNNING_DIR = "running"
+    DONE_DIR = "done"
+    FAILED_DIR = "failed"
+    STATUS_FNAME = "worker_status.json"
+    JOB_SUFFIX = ".job"
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, spool_path, max_jobs=None, poll_interval=None,
+                 job_timeout=None):
+        if max_jobs is None:
+            max_jobs = _UT_CONFIG_.worker_max_jobs
+        if poll_interval is None:
+            poll_interval = _UT_CONFIG_.worker_poll_interval
+        if job_timeout is None:
+            job_timeout = _UT_CONFIG_.worker_job_timeout
+        self.spool_path = spool_path
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.lock = threading.Lock()
+        # fname -> [start_ts, submit_ts, pid, settling], pid None until
+        # reported
+        self.running = {}
+        self.job_pids = SimpleQueue()
+        self.done_cnt = 0
+        self.failed_cnt = 0
+        self.latencies = []
+        self.stopping = False
+        for name in [self.RUNNING_DIR, self.DONE_DIR, self.FAILED_DIR]:
+            path = os.path.join(spool_path, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def stop(self, signum=None, frame=None):
+        logger.info("Worker: stop requested, finishing in-flight jobs")
+        self.stopping = True
+
+    def pending_jobs(self):
+        jobs = []
+        for fname in os.listdir(self.spool_path):
+            fpath = os.path.join(self.spool_path, fname)
+            if fname.endswith(self.JOB_SUFFIX) and os.path.isfile(fpath):
+                jobs.append((os.path.getmtime(fpath), fname))
+        jobs.sort()
+        return [fname for mtime, fname in jobs]
+
+    # another worker on the same spool may win the rename
+    def claim_job(self, fname):
+        src = os.path.join(self.spool_path, fname)
+        dst = os.path.join(self.spool_path, self.RUNNING_DIR, fname)
+        try:
+            submit_ts = os.path.getmtime(src)
+            os.rename(src, dst)
+        except OSError:
+            return None, None
+        return dst, submit_ts
+
+    def send_notify(self, job_result):
+        notify_fpath, subject, msg_body = job_result.pop("notify")
+        try:
+            UtNotify(notify_fpath).post(subject, msg_body, job_result["ok"])
+        except Exception as e:
+            logger.error("Worker: fail to notify %s, %s", subject, e)
+
+    # settles a job once, either from the pool callback or as lost
+    def on_job_done(self, fname, submit_ts, start_ts, job_result):
+        with self.lock:
+            job = self.running.get(fname)
+            if job is None or job[3]:
+                return
+            job[3] = True
+        latency = time.time() - submit_ts
+        queue_wait = start_ts - submit_ts
+        job_result["queue_wait"] = queue_wait
+        job_result["latency"] = latency
+        if job_result["ok"]:
+            dst_dir = self.DONE_DIR
+        else:
+            dst_dir = self.FAILED_DIR
+        try:
+            if "notify" in job_result:
+                self.send_notify(job_result)
+            src = os.path.join(self.spool_path, self.RUNNING_DIR, fname)
+            dst = os.path.join(self.spool_path, dst_dir, fname)
+            os.rename(src, dst)
+            with open(dst + ".result", "w") as f:
+                f.write(json.dumps(job_result) + "\n")
+        finally:
+            with self.lock:
+                del self.running[fname]
+                if job_result["ok"]:
+                    self.done_cnt += 1
+                else:
+                    self.failed_cnt += 1
+                self.latencies.append(latency)
+                self.latencies = self.latencies[-self.LATENCY_WINDOW:]
+        logger.info("Worker: job %s %s, queue wait %.2fs, latency %.2fs",
+                    fname, dst_dir, queue_wait, latency)
+
+    def read_job_pids(self):
+        while not self.job_pids.empty():
+            fname, pid = self.job_pids.get()
+            with self.lock:
+                if fname in self.running:
+                    self.running[fname][2] = pid
+
+    def is_alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return False
+        return True
+
+    # apply_async has no error callback, a job whose pool process died
+    # never gets its result. The pool replaces the process, the job is
+    # failed here. A job past the timeout has its process killed first.
+    def reap_lost_jobs(self):
+        self.read_job_pids()
+        now = time.time()
+        with self.lock:
+            running = [(fname, job[0], job[1], job[2])
+                       for fname, job in self.running.iteritems()
+                       if not job[3]]
+        for fname, start_ts, submit_ts, pid in running:
+            if pid is None:
+                continue
+            if self.job_timeout > 0 and now - start_ts > self.job_timeout:
+                logger.error("Worker: job %s timed out, kill pid %d",
+                             fname, pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                error = "Job timed out after {0}s".format(self.job_timeout)
+            elif not self.is_alive(pid):
+                error = "Job process {0} died".format(pid)
+            else:
+                continue
+            logger.error("Worker: job %s lost, %s", fname, error)
+            job_result = {"job":fname, "ok":False, "error":error,
+                          "run_time":now - start_ts}
+            try:
+                self.on_job_done(fname, submit_ts, start_ts, job_result)
+            except Exception as e:
+                logger.error("Worker: fail to finish job %s, %s", fname, e)
+
+    def submit_job(self, proc_pool, fname):
+        job_fpath, submit_ts = self.claim_job(fname)
+        if job_fpath is None:
+            return
+        start_ts = time.time()
+        with self.lock:
+            self.running[fname] = [start_ts, submit_ts, None, False]
+        # an exception here would stop the result thread of the pool
+        def callback(job_result):
+            try:
+                self.on_job_done(fname, submit_ts, start_ts, job_result)
+            except Exception as e:
+                logger.error("Worker: fail to finish job %s, %s", fname, e)
+        proc_pool.apply_async(run_job, (job_fpath, self.spool_path),
+                              callback=callback)
+
+    def running_cnt(self):
+        with self.lock:
+            return len(self.running)
+
+    def status(self, pending_cnt):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            status = {"pending":pending_cnt, "running":len(self.running),
+                      "done":self.done_cnt, "failed":self.failed_cnt}
+        if len(latencies) > 0:
+            status["latency_avg"] = sum(latencies) / len(latencies)
+            status["latency_p50"] = latencies[len(latencies)/2]
+            status["latency_max"] = latencies[-1]
+        return status
+
+    def write_status(self, status):
+        fpath = os.path.join(self.spool_path, self.STATUS_FNAME)
+        with open(fpath + ".tmp", "w") as f:
+            f.write(json.dumps(status) + "\n")
+        os.rename(fpath + ".tmp", fpath)
+
+    def serve(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        proc_pool = multiprocessing.Pool(self.max_jobs, init_job_process,
+                                         (self.job_pids,))
+        logger.info("Worker: serve %s, %d jobs at most", self.spool_path,
+                    self.max_jobs)
+        last_status = None
+        try:
+            while not self.stopping:
+                self.reap_lost_jobs()
+                pending = self.pending_jobs()
+                for fname in pending:
+                    with self.lock:
+                        if len(self.running) >= self.max_jobs:
+                            break
+                    self.submit_job(proc_pool, fname)
+                status = self.status(len(self.pending_jobs()))
+                self.write_status(status)
+                if status != last_status:
+                    logger.info("Worker: status %s", status)
+                    last_status = status
+                time.sleep(self.poll_interval)
+        finally:
+            # a lost job stays in the pool cache and join would wait on it
+            # forever, wait for the jobs to settle and terminate instead
+            proc_pool.close()
+            while self.running_cnt() > 0:
+                self.reap_lost_jobs()
+                time.sleep(self.poll_interval)
+            proc_pool.terminate()
+            proc_pool.join()
+            self.write_status(self.status(len(self.pending_jobs())))
+            logger.info("Worker: stopped")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Compare the per-pattern re.search loop with CmdRegexMatcher, over a
+# group of error code literals sharing a prefix plus a few regexes
+# usage: bench_regex.py [output_mb ...]
+
+import sys
+import time
+import random
+import string
+from UtScript import CmdRegex, CmdRegexMatcher
+
+OUTPUT_MB = [1, 4, 16]
+PTN_CNT = [2, 5, 10, 20, 50, 100]
+ROUNDS = 3
+
+def gen_output(size):
+    rnd = random.Random(size)
+    words = []
+    for i in xrange(2000):
+        n = rnd.randint(3, 10)
+        words.append("".join([rnd.choice(string.ascii_lowercase) \
+                              for j in xrange(n)]))
+    lines, total = [], 0
+    while total < size:
+        line = " ".join([rnd.choice(words) for j in xrange(12)])
+        lines.append(line)
+        total += len(line) + 1
+    # a few hits near the end, most patterns never match
+    lines.append("ERR_CODE_6 reported")
+    lines.append("worker 12 failed with status 3")
+    return "\n".join(lines)
+
+# cnt literals, and one regex for every 10 of them
+def gen_patterns(cnt):
+    ptns = []
+    for i in xrange(cnt):
+        ptns.append("ERR_CODE_{0}".format(i * 2))
+    for i in xrange(cnt / 10):
+        ptns.append(r"worker \d+ fail(ed|ure) with status {0}".format(i))
+    return ptns
+
+def gen_operands(ptns):
+    operands = []
+    for ptn in ptns:
+        cmd_regex = CmdRegex({CmdRegex.TYPE:CmdRegex.TYPE_PTN,
+                              CmdRegex.VALUE:ptn})
+        cmd_regex.idx = len(operands)
+        operands.append(cmd_regex)
+    return operands
+
+def search_loop(operands, s):
+    return [cmd_regex.match_ptn(s) for cmd_regex in operands]
+
+def matcher_loop(matcher, operands, s):
+    match = matcher.match_func(s)
+    return [match(cmd_regex) for cmd_regex in operands]
+
+def timeit(func, *args):
+    best = None
+    for i in xrange(ROUNDS):
+        start = time.time()
+        func(*args)
+        cost = time.time() - start
+        if best is None or cost < best:
+            best = cost
+    return best
+
+def main():
+    if len(sys.argv) > 1:
+        output_mb = [int(x) for x in sys.argv[1:]]
+    else:
+        output_mb = OUTPUT_MB
+    print "{0:>6} {1:>6} {2:>12} {3:>12} {4:>8}".format(\
+        "MB", "ptns", "search(s)", "matcher(s)", "speedup")
+    for mb in output_mb:
+        s = gen_output(mb * 1024 * 1024)
+        for cnt in PTN_CNT:
+            operands = gen_operands(gen_patterns(cnt))
+            matcher = CmdRegexMatcher(operands)
+            if matcher_loop(matcher, operands, s) != \
+               search_loop(operands, s):
+                raise Exception("Matcher result mismatch, {0} ptns".format(cnt))
+            t1 = timeit(search_loop, operands, s)
+            t2 = timeit(matcher_loop, matcher, operands, s)
+            print "{0:>6} {1:>6} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(\
+                mb, len(operands), t1, t2, t1/t2)
+
+if __name__ == "__main__":
+    main()
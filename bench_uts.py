@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Measure the harness overhead against an in-process fake SSH server with
+# canned outputs. Every workload runs one whole session and times
+# connect, exec_cmd, regex evaluation, log flush, report generation and
+# each command end to end. One JSON line is printed per workload and
+# component, e.g.
+# {"workload": {"cmds": 100, "out_size": 4096, "regex": 10,
+#  "exec_cnt": 1, "latency_ms": 0}, "component": "exec_cmd",
+#  "count": 100, "total_s": 0.41, "ops_per_s": 243.9, "p50_ms": 3.9,
+#  "p99_ms": 6.2}
+# usage: bench_uts.py [--cmds 10,100] [--out-size 1024,65536]
+#                     [--regex 0,10] [--exec-cnt 1,5] [--latency-ms 0,5]
+#                     [--baseline former.jsonl]
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import paramiko
+from UtLogger import logger
+from UtTiming import monotonic, percentile
+from UtConfig import _UT_CONFIG_
+
+BENCH_CMD = "uts_bench"
+BENCH_USER = "bench"
+BENCH_PWD = "bench"
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    # reply once the request is acknowledged
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=self.listener.reply,
+                             args=(channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+# Accepts SSH connections on 127.0.0.1. "uts_bench <size>" prints <size>
+# bytes of numbered lines after latency_ms, any other cmd prints nothing.
+class FakeSSHListener(object):
+    LINE_FMT = "bench line {0:06d} status ok\n"
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.outputs = {}
+        self.lock = threading.Lock()
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.stopping = False
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while not self.stopping:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            t = threading.Thread(target=self.start_transport, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def start_transport(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        with self.lock:
+            self.transports.append(transport)
+        try:
+            transport.start_server(server=FakeSSHServer(self))
+        except Exception as e:
+            logger.warning("Bench: handshake failed, %s", e)
+
+    def gen_output(self, size):
+        with self.lock:
+            if size in self.outputs:
+                return self.outputs[size]
+        lines, total, i = [], 0, 0
+        while total < size:
+            line = self.LINE_FMT.format(i)
+            lines.append(line)
+            total += len(line)
+            i += 1
+        out = "".join(lines)[:size]
+        with self.lock:
+            self.outputs[size] = out
+        return out
+
+    def reply(self, channel, command):
+        args = command.split()
+        out = ""
+        if len(args) == 2 and args[0] == BENCH_CMD:
+            out = self.gen_output(int(args[1]))
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000.0)
+        try:
+            channel.sendall(out)
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+    def ssh_config(self):
+        return {"host_ip":"127.0.0.1", "host_port":self.port,
+                "username":BENCH_USER, "password":BENCH_PWD}
+
+    def close(self):
+        self.stopping = True
+        self.sock.close()
+        with self.lock:
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+
+# every pattern matches the canned output, so each cmd succeeds after
+# evaluating the whole group
+def gen_regex(cnt):
+    regex_list = []
+    for i in xrange(cnt):
+        if i > 0:
+            regex_list.append({"type":"oper", "value":"and"})
+        if i % 2 == 0:
+            ptn = "status ok"
+        else:
+            ptn = r"line \d+ status (ok|fail)"
+        regex_list.append({"type":"ptn", "value":ptn})
+    return regex_list
+
+def gen_script(workload):
+    script = []
+    for i in xrange(workload["cmds"]):
+        cmd_data = {"cmdline":"{0} {1}".format(BENCH_CMD,
+                                               workload["out_size"]),
+                    "exec_cnt":workload["exec_cnt"]}
+        if workload["regex"] > 0:
+            cmd_data["regex"] = gen_regex(workload["regex"])
+        script.append(cmd_data)
+    return script
+
+# record the duration of every call of obj.name
+def timed(obj, name, samples):
+    func = getattr(obj, name)
+    def wrapper(*args, **kwargs):
+        start = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(monotonic() - start)
+    setattr(obj, name, wrapper)
+
+def summarize(workload, component, samples, total=None):
+    if total is None:
+        total = sum(samples)
+    x = {"workload":workload, "component":component, "count":len(samples),
+         "total_s":total}
+    if len(samples) > 0:
+        samples = sorted(samples)
+        x["ops_per_s"] = len(samples) / total if total > 0 else 0.0
+        x["p50_ms"] = percentile(samples, 50) * 1000
+        x["p99_ms"] = percentile(samples, 99) * 1000
+    return x
+
+def run_workload(listener, workload, work_path):
+    from UtSession import UtSession
+    script_fpath = os.path.join(work_path, "script.json")
+    with open(script_fpath, "w") as f:
+        f.write(json.dumps(gen_script(workload)))
+    notify_fpath = os.path.join(work_path, "notify.json")
+    with open(notify_fpath, "w") as f:
+        f.write(json.dumps({"recipient":"bench@localhost"}))
+
+    listener.latency_ms = workload["latency_ms"]
+    session = UtSession(listener.ssh_config(), script_fpath, notify_fpath)
+    samples = {}
+    for name in ["connect", "exec_cmd", "regex", "log_flush", "report",
+                 "cmd"]:
+        samples[name] = []
+    timed(session.ssh, "connect", samples["connect"])
+    timed(session.ssh, "exec_cmd", samples["exec_cmd"])
+    timed(session.log, "flush", samples["log_flush"])
+    timed(session.script, "generate_report", samples["report"])
+    timed(session.script, "exec_rounds", samples["cmd"])
+    for cmd in session.script.cmd_list:
+        timed(cmd.regex_grp, "evaluate", samples["regex"])
+
+    start = monotonic()
+    session.prepare()
+    session.go()
+    wall = monotonic() - start
+    if session.result.result != True:
+        err = "Bench session failed:\n{0}".format(session.result.detail())
+        raise Exception(err)
+
+    results = []
+    for name in ["connect", "exec_cmd", "regex", "log_flush", "report",
+                 "cmd"]:
+        results.append(summarize(workload, name, samples[name]))
+    results.append(summarize(workload, "session", samples["cmd"], wall))
+    return results
+
+def parse_int_list(s):
+    return [int(x) for x in s.split(",")]
+
+def workload_key(x):
+    w = x["workload"]
+    return (w["cmds"], w["out_size"], w["regex"], w["exec_cnt"],
+            w["latency_ms"], x["component"])
+
+def print_compare(results, baseline_fpath):
+    baseline = {}
+    with open(baseline_fpath, "r") as f:
+        for line in f:
+            x = json.loads(line)
+            baseline[workload_key(x)] = x
+    fmt = "{0:<32} {1:<10} {2:>10} {3:>10} {4:>10}"
+    sys.stderr.write(fmt.format("workload", "component", "p50", "p99",
+                                "ops/s") + "\n")
+    for x in results:
+        y = baseline.get(workload_key(x))
+        if y is None or "p50_ms" not in x or "p50_ms" not in y:
+            continue
+        change = []
+        for name in ["p50_ms", "p99_ms", "ops_per_s"]:
+            if y[name] > 0:
+                change.append("{0:+.1f}%".format(
+                    (x[name] - y[name]) * 100.0 / y[name]))
+            else:
+                change.append("-")
+        w = "{cmds}c/{out_size}B/{regex}r/{exec_cnt}x/{latency_ms}ms".format(
+            **x["workload"])
+        sys.stderr.write(fmt.format(w, x["component"], *change) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cmds", default="10,100")
+    parser.add_argument("--out-size", default="1024,65536")
+    parser.add_argument("--regex", default="0,10")
+    parser.add_argument("--exec-cnt", default="1")
+    parser.add_argument("--latency-ms", default="0")
+    parser.add_argument("--baseline",
+                        help="former output, changes are printed to stderr")
+    args = parser.parse_args()
+
+    # the log handler writes to stdout, keep it for the results
+    logger.setLevel(logging.WARNING)
+    work_path = tempfile.mkdtemp(prefix="uts_bench_")
+    _UT_CONFIG_.root_path = work_path
+    listener = FakeSSHListener()
+    results = []
+    try:
+        for cmds, out_size, regex, exec_cnt, latency_ms in itertools.product(
+                parse_int_list(args.cmds), parse_int_list(args.out_size),
+                parse_int_list(args.regex), parse_int_list(args.exec_cnt),
+                parse_int_list(args.latency_ms)):
+            workload = {"cmds":cmds, "out_size":out_size, "regex":regex,
+                        "exec_cnt":exec_cnt, "latency_ms":latency_ms}
+            for x in run_workload(listener, workload, work_path):
+                print json.dumps(x, sort_keys=True)
+                sys.stdout.flush()
+                results.append(x)
+    finally:
+        listener.close()
+        shutil.rmtree(work_path, ignore_errors=True)
+    if args.baseline is not None:
+        print_compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Print the JSON array view of a JSON Lines session log, outputs kept in
+# the blob store are inlined
+# usage: convert_log.py <session path>/log.jsonl > log.json
+
+import os
+import sys
+from UtLog import write_json_array, find_blob_store
+
+fpath = sys.argv[1]
+blob_store = find_blob_store(os.path.dirname(os.path.abspath(fpath)))
+write_json_array(fpath, sys.stdout, blob_store)
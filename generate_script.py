@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+# One cmd per line of the input file, written as a JSON Lines script with
+# a total_cmd header, or as a JSON array with --json
+# usage: generate_script.py [--json] cmds.txt > script.jsonl
+
 import sys
 import json
-from UtScript import UtCmd
+from UtScript import UtCmd, UtScript
+
+args = sys.argv[1:]
+as_array = "--json" in args
+fpath = [x for x in args if x != "--json"][0]
+
+if as_array:
+    with open(fpath, "r") as f:
+        script_data = []
+        for line in f:
+            script_data.append({UtCmd.CMDLINE:line.strip()})
+    print json.dumps(script_data)
+    sys.exit(0)
 
-with open(sys.argv[1], "r") as f:
-    script_data = []
-    for line in f.readlines():
-        script_data.append({UtCmd.CMDLINE:line.strip()})
-print json.dumps(script_data)
+# count first, so the header comes before the cmds
+with open(fpath, "r") as f:
+    total = 0
+    for line in f:
+        total += 1
+sys.stdout.write(json.dumps({UtScript.TOTAL_CMD:total}) + "\n")
+with open(fpath, "r") as f:
+    for line in f:
+        sys.stdout.write(json.dumps({UtCmd.CMDLINE:line.strip()}) + "\n")
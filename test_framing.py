@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Framing of batched cmds and session shell cmds, and the parsing of the
+# framed output. The framed scripts are also run by a local sh, as the
+# remote shell would.
+# usage: python -m unittest test_framing
+
+import os
+import uuid
+import unittest
+import subprocess
+from UtSSH import UtSSH
+from UtShell import UtShell
+
+SSH_CONFIG = {"host_ip":"127.0.0.1", "host_port":22, "username":"uts",
+              "password":"uts"}
+
+def run_sh(script):
+    p = subprocess.Popen(["sh"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate(script)
+    return out, err
+
+class TestBatchFraming(unittest.TestCase):
+    def setUp(self):
+        self.ssh = UtSSH(SSH_CONFIG)
+        self.mark = UtSSH.BATCH_MARK + uuid.uuid4().hex + "_"
+
+    def run_batch(self, cmdlines):
+        out, err = run_sh(self.ssh.frame_batch(cmdlines, self.mark))
+        return self.ssh.split_batch(len(cmdlines), self.mark, out, err)
+
+    def test_split(self):
+        results = self.run_batch(["echo a", "printf b", "echo c; echo d"])
+        self.assertEqual(results, [(True, "a\n", ""), (True, "b", ""),
+                                   (True, "c\nd\n", "")])
+
+    def test_stop_at_stderr(self):
+        results = self.run_batch(["echo a", "echo out; echo e >&2",
+                                  "echo never"])
+        self.assertEqual(results, [(True, "a\n", ""),
+                                   (True, "out\n", "e\n")])
+
+    # a cmd cannot break the framing by changing the state of the shell
+    def test_subshell(self):
+        results = self.run_batch(["cd /; exec 1>&-", "pwd"])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1], (True, os.getcwd() + "\n", ""))
+
+    def test_marks_of_other_batch(self):
+        other = UtSSH.BATCH_MARK + uuid.uuid4().hex + "_"
+        cmdline = "printf '\\n%s 0\\n' {0}0".format(other)
+        results = self.run_batch([cmdline])
+        self.assertEqual(results,
+                         [(True, "\n{0}0 0\n".format(other), "")])
+
+    def test_canned(self):
+        out = "a\n\n{0}0 0\nb\n{0}1 1\n".format(self.mark)
+        err = "\n{0}0\nboom\n{0}1\n".format(self.mark)
+        self.assertEqual(self.ssh.split_batch(2, self.mark, out, err),
+                         [(True, "a\n", ""), (True, "b", "boom")])
+
+    # output cut short, e.g. by a timeout, gives the cmds completed only
+    def test_canned_incomplete(self):
+        out = "a\n\n{0}0 0\nb\n".format(self.mark)
+        err = "\n{0}0\n".format(self.mark)
+        self.assertEqual(self.ssh.split_batch(2, self.mark, out, err),
+                         [(True, "a\n", "")])
+        err = ""
+        self.assertEqual(self.ssh.split_batch(2, self.mark, out, err), [])
+
+class TestShellFraming(unittest.TestCase):
+    def setUp(self):
+        self.shell = UtShell(None)
+        self.mark = UtShell.END_MARK + uuid.uuid4().hex
+
+    def parse(self, out, err):
+        out_end, status = self.shell.find_out_mark(out, self.mark, 0)
+        err_end = err.find("\n{0}\n".format(self.mark))
+        if out_end < 0 or err_end < 0:
+            return None
+        return status, out[:out_end], err[:err_end]
+
+    def run_cmd(self, cmdline):
+        out, err = run_sh(self.shell.frame_cmd(cmdline, self.mark))
+        return self.parse(out, err)
+
+    def test_status(self):
+        self.assertEqual(self.run_cmd("echo a"), (0, "a\n", ""))
+        self.assertEqual(self.run_cmd("echo e >&2; false"), (1, "", "e\n"))
+        self.assertEqual(self.run_cmd("sh -c 'exit 7'"), (7, "", ""))
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(self.run_cmd("printf abc"), (0, "abc", ""))
+        self.assertEqual(self.run_cmd("printf abc >&2"), (0, "", "abc"))
+
+    # a pty echoes the framed cmd back, the mark in it is not at the start
+    # of a line
+    def test_echoed_frame(self):
+        frame = self.shell.frame_cmd("echo a", self.mark)
+        out = frame.replace("\n", "\r\n") + "a\n\n{0} 0\n".format(self.mark)
+        err = "\n{0}\n".format(self.mark)
+        self.assertEqual(self.parse(out, err)[0], 0)
+        self.assertTrue(self.parse(out, err)[1].endswith("a\n"))
+
+    def test_partial_mark(self):
+        out = "a\n\n{0} 0".format(self.mark)
+        self.assertEqual(self.shell.find_out_mark(out, self.mark, 0),
+                         (-1, None))
+        out += "\n"
+        self.assertEqual(self.shell.find_out_mark(out, self.mark, 0),
+                         (2, 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Random regex groups over random outputs: the expression tree, the
+# three-valued settle and CmdRegexStream fed in random chunks must all
+# agree with a plain evaluation of every pattern.
+# usage: python -m unittest test_regex
+
+import re
+import random
+import logging
+import unittest
+from UtLogger import logger
+from UtScript import CmdRegex, CmdRegexGrp, CmdRegexStream
+
+ROUNDS = 2000
+ALPHABET = "abc\n"
+# patterns match at most a few chars, well within the overlap below
+TOKENS = ["a", "b", "c", ".", "[ab]", "\n", "b?"]
+
+def gen_ptn(rnd):
+    if rnd.random() < 0.3:
+        # literals sharing a prefix, searched in one pass by the matcher
+        return "abca" + "".join([rnd.choice("abc") \
+                                 for i in xrange(rnd.randint(0, 2))])
+    ptn = "".join([rnd.choice(TOKENS) for i in xrange(rnd.randint(1, 3))])
+    if rnd.random() < 0.2:
+        ptn = "^" + ptn
+    if rnd.random() < 0.2:
+        ptn = ptn + "$"
+    if rnd.random() < 0.2:
+        ptn = "(?m)" + ptn
+    return ptn
+
+# [ptn, oper, ptn, ...] and the regex group data of it
+def gen_group(rnd):
+    items, regex_list = [], []
+    for i in xrange(rnd.randint(1, 6)):
+        if i > 0:
+            oper = rnd.choice([CmdRegex.OPER_AND, CmdRegex.OPER_OR])
+            items.append(oper)
+            regex_list.append({"type":"oper", "value":oper})
+        negated = rnd.random() < 0.25
+        if negated:
+            regex_list.append({"type":"oper", "value":CmdRegex.OPER_NOT})
+        ptn = gen_ptn(rnd)
+        items.append((negated, ptn))
+        regex_list.append({"type":"ptn", "value":ptn})
+    return items, regex_list
+
+def gen_output(rnd):
+    return "".join([rnd.choice(ALPHABET) \
+                    for i in xrange(rnd.randint(0, 60))])
+
+# NOT binds tightest, AND and OR alike from left to right
+def plain_evaluate(items, s):
+    value = None
+    oper = None
+    for item in items:
+        if not isinstance(item, tuple):
+            oper = item
+            continue
+        negated, ptn = item
+        x = re.search(ptn, s) is not None
+        if negated:
+            x = not x
+        if oper is None:
+            value = x
+        elif oper == CmdRegex.OPER_AND:
+            value = value and x
+        else:
+            value = value or x
+    return value
+
+class TestCmdRegex(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(20261017)
+        self.log_level = logger.level
+        logger.setLevel(logging.WARNING)
+        self.overlap = CmdRegexStream.OVERLAP
+        CmdRegexStream.OVERLAP = 8
+
+    def tearDown(self):
+        CmdRegexStream.OVERLAP = self.overlap
+        logger.setLevel(self.log_level)
+
+    def test_evaluate(self):
+        for i in xrange(ROUNDS):
+            items, regex_list = gen_group(self.rnd)
+            s = gen_output(self.rnd)
+            grp = CmdRegexGrp(regex_list)
+            self.assertEqual(grp.evaluate(s) == "", plain_evaluate(items, s),
+                             (regex_list, s))
+
+    # a pattern matched in a prefix is matched for good, unless anchored
+    # at the end; the others are still unknown
+    def test_settle(self):
+        for i in xrange(ROUNDS):
+            items, regex_list = gen_group(self.rnd)
+            s = gen_output(self.rnd)
+            grp = CmdRegexGrp(regex_list)
+            expected = plain_evaluate(items, s)
+            for n in xrange(len(s) + 1):
+                matched = [not x.ptn.endswith("$") and \
+                           re.search(x.ptn, s[:n]) is not None \
+                           for x in grp.operands]
+                value = grp.expr.settle(matched)
+                if value is not None:
+                    self.assertEqual(value, expected, (regex_list, s, n))
+
+    def test_stream(self):
+        for i in xrange(ROUNDS):
+            items, regex_list = gen_group(self.rnd)
+            s = gen_output(self.rnd)
+            grp = CmdRegexGrp(regex_list)
+            stream = grp.stream()
+            pos = 0
+            while pos < len(s):
+                n = self.rnd.randint(1, 12)
+                stream.feed(s[pos:pos+n])
+                pos += n
+            self.assertEqual(stream.finish() == "", plain_evaluate(items, s),
+                             (regex_list, s))
+
+if __name__ == "__main__":
+    unittest.main()
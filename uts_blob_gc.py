@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Remove the blobs of the shared store no session log refers to anymore,
+# run it after deleting sessions, e.g.
+# uts_blob_gc.py --min-age 86400
+
+import argparse
+from UtLog import gc_shared_blobs
+from UtConfig import _UT_CONFIG_
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-age", type=int,
+                        default=_UT_CONFIG_.blob_gc_min_age,
+                        help="seconds a blob is kept after its last use")
+    args = parser.parse_args()
+
+    cnt, size = gc_shared_blobs(min_age=args.min_age)
+    print "{0} blobs removed, {1} bytes".format(cnt, size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Cmd durations over the run history, e.g.
+# uts_history.py --host uname@1.1.1.1:22 --since 2026-01-01
+# uts_history.py --trend "make test" --bucket 6
+# uts_history.py --regress
+
+import datetime
+import argparse
+from UtHistory import UtHistory, format_stats, format_regressions
+from UtConfig import _UT_CONFIG_
+from uts_query import parse_ts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cmd", help="cmdline")
+    parser.add_argument("--host", help="user@host:port")
+    parser.add_argument("--since", help="YYYY-mm-dd [HH:MM[:SS]]")
+    parser.add_argument("--until", help="YYYY-mm-dd [HH:MM[:SS]]")
+    parser.add_argument("--trend", metavar="CMDLINE",
+                        help="percentiles of a cmdline over time")
+    parser.add_argument("--bucket", type=float, default=24,
+                        help="hours per line of --trend")
+    parser.add_argument("--regress", action="store_true",
+                        help="cmdlines slower over the last {0} days than "
+                             "the {1} days before".format(\
+                             _UT_CONFIG_.history_recent_days,
+                             _UT_CONFIG_.history_baseline_days))
+    args = parser.parse_args()
+
+    history = UtHistory()
+    since, until = parse_ts(args.since), parse_ts(args.until)
+    if args.regress:
+        print format_regressions(history.regressions(args.host)),
+    elif args.trend is not None:
+        print "{0:<16} {1:>7} {2:>9} {3:>9} {4:>9}".format(\
+              "from", "count", "p50", "p95", "p99")
+        for x in history.cmd_trend(args.trend, args.host, since, until,
+                                   int(args.bucket * 3600)):
+            ts = datetime.datetime.fromtimestamp(x["ts"])
+            print "{0:<16} {1:>7} {2:>9.3f} {3:>9.3f} {4:>9.3f}".format(\
+                  ts.strftime("%Y-%m-%d %H:%M"), x["count"], x["p50"],
+                  x["p95"], x["p99"])
+    else:
+        print format_stats(history.cmd_stats(args.cmd, args.host, since,
+                                             until)),
+    history.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Query the command index of all sessions, most recently indexed first,
+# e.g.
+# uts_query.py --host uname@1.1.1.1:22 --cmd "make test" --failed --limit 1
+
+import time
+import datetime
+import argparse
+from UtIndex import UtIndex, UtIndexRecord
+from UtLog import output_text
+
+TS_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+def parse_ts(s):
+    if s is None:
+        return None
+    for ts_fmt in TS_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(s, ts_fmt)
+        except ValueError:
+            continue
+        return int(time.mktime(dt.timetuple()))
+    err = "Invalid time {0}, expect one of {1}".format(s, TS_FORMATS)
+    raise Exception(err)
+
+def print_output(index, x):
+    entry = index.read_result(x)
+    for name, text in [("out", entry.out), ("err", entry.err)]:
+        if text == "":
+            continue
+        print "  {0}:".format(name)
+        for line in output_text(text).split("\n"):
+            print ("    " + line).encode("utf-8")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ses", help="session id")
+    parser.add_argument("--host", help="user@host:port")
+    parser.add_argument("--cmd", help="substring of the cmdline")
+    parser.add_argument("--rc", type=int, help="return code")
+    parser.add_argument("--failed", action="store_true",
+                        help="commands with a non-zero return code")
+    parser.add_argument("--since", help="YYYY-mm-dd [HH:MM[:SS]]")
+    parser.add_argument("--until", help="YYYY-mm-dd [HH:MM[:SS]]")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--output", action="store_true",
+                        help="print out/err of matched commands")
+    parser.add_argument("--reindex", action="store_true",
+                        help="index sessions missing from the index")
+    args = parser.parse_args()
+
+    index = UtIndex()
+    if args.reindex:
+        print "{0} sessions indexed".format(index.reindex())
+        return
+    for x in index.query(args.ses, args.host, args.cmd, args.rc, args.failed,
+                         parse_ts(args.since), parse_ts(args.until),
+                         args.limit):
+        print UtIndexRecord.format_line(x)
+        if args.output:
+            print_output(index, x)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Validate scripts without running them, valid JSON array scripts are
+# added to the script cache so the jobs running them skip parsing and
+# validation
+# usage: uts_validate.py [--no-cache] script.json [script.json ...]
+
+import sys
+import time
+import argparse
+from UtScript import UtScript
+
+def validate(fpath, use_cache):
+    start = time.time()
+    try:
+        script = UtScript(fpath, use_cache)
+        total = script.total_cmd()
+        if script.json_lines:
+            # every line is built and validated here
+            cmd_cnt, count = 0, 0
+            for cmd in script.iter_cmds():
+                cmd_cnt += 1
+                count += cmd.exec_cnt
+            if count != total:
+                err = "Header total_cmd {0}, cmds add up to {1}".format(\
+                      total, count)
+                raise Exception(err)
+        else:
+            cmd_cnt = len(script.cmd_list)
+    except Exception as e:
+        print "FAIL {0}:\n{1}".format(fpath, str(e))
+        return False
+    if script.from_cache:
+        state = "cached"
+    elif use_cache and not script.json_lines:
+        state = "validated, cached now"
+    else:
+        state = "validated"
+    print "OK   {0}: {1} cmds, {2} executions, {3} in {4:.2f}s".format(\
+          fpath, cmd_cnt, total, state, time.time() - start)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-cache", action="store_true",
+                        help="neither read nor write the script cache")
+    parser.add_argument("scripts", nargs="+")
+    args = parser.parse_args()
+    failed = 0
+    for fpath in args.scripts:
+        if not validate(fpath, not args.no_cache):
+            failed += 1
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
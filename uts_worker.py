@@ -1,10 +1,49 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import argparse
+from UtFleet import UtFleet
 from UtSession import UtSession
+from UtConfig import _UT_CONFIG_
 
-json_input = ["ssh_config.json", "test_script.json", "notify.json"]
-session = UtSession(*json_input)
-session.prepare()
-session.go()
-session.send_notify()
+# a session id, or the path of its directory
+def find_ses_path(ses):
+    if os.path.isdir(ses):
+        return ses
+    return os.path.join(_UT_CONFIG_.root_path, _UT_CONFIG_.session_dir, ses)
+
+def run_once(json_input, resume_from=None):
+    fleet = UtFleet(*json_input)
+    if len(fleet.host_configs) > 1:
+        if resume_from is not None:
+            raise Exception("Resume runs one host only")
+        fleet.go()
+        fleet.send_notify()
+    else:
+        session = UtSession(*json_input, resume_from=resume_from)
+        session.prepare()
+        session.go()
+        session.send_notify()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spool", help="serve jobs from a spool directory")
+    parser.add_argument("--jobs", type=int, help="max concurrent jobs")
+    parser.add_argument("--resume", metavar="SES",
+                        help="go on from the checkpoint of a former session")
+    args = parser.parse_args()
+    if args.spool is None:
+        resume_from = None
+        if args.resume is not None:
+            resume_from = find_ses_path(args.resume)
+        run_once(["ssh_config.json", "test_script.json", "notify.json"],
+                 resume_from)
+        return
+
+    from UtWorker import UtWorker
+    worker = UtWorker(args.spool, args.jobs)
+    worker.serve()
+
+if __name__ == "__main__":
+    main()